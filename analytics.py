@@ -0,0 +1,215 @@
+import logging
+import os
+import time
+import uuid
+from functools import lru_cache
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+import db
+import models
+
+# Optional columnar engine for the project-wide views. With
+# ANALYTICS_ENGINE=duckdb, their queries run in DuckDB over a Parquet
+# export of the tables they read, written by `cli.py export-analytics`.
+# The export records the DataVersion of the database it was written from:
+# once an upload or project deletion changes the database, they read it
+# again until the export is run again. Without the setting or the export,
+# or if DuckDB cannot run a query, they read the database as before.
+ANALYTICS_ENGINE = os.getenv('ANALYTICS_ENGINE', '')
+ANALYTICS_PATH = os.getenv('ANALYTICS_PATH', 'data/analytics')
+
+# The columns exported of each table, None for all of them
+EXPORT_COLUMNS = {
+    'matrix_results': None,
+    'models': None,
+    'drugs': None,
+    'combinations': None,
+    # only what the synergy heatmaps take the range of across all matrices
+    'well_results': ['inhibition', 'hsa', 'hsa_excess', 'bliss_additivity',
+                     'bliss_excess'],
+}
+
+# DuckDB reads PostgreSQL's SQL. Named parameters, so that `%` in inlined
+# strings is not doubled as for psycopg2.
+DUCKDB_DIALECT = postgresql.dialect(paramstyle='named')
+
+logger = logging.getLogger(__name__)
+
+# The DuckDB SQL of the statements DuckDB failed to run, which then read
+# the database without trying DuckDB again
+FAILED_QUERIES = set()
+# The (export, database) DataVersions already warned about
+STALE_VERSIONS = set()
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("ANALYTICS_ENGINE=duckdb requires duckdb "
+                          "(pip install duckdb)")
+    return duckdb
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Exporting tables to Parquet requires pyarrow "
+                          "(pip install pyarrow)")
+    return pyarrow
+
+
+def export_file(table, path=ANALYTICS_PATH):
+    return os.path.join(path, f"{table}.parquet")
+
+
+def export_exists(path=ANALYTICS_PATH):
+    return all(os.path.isfile(export_file(t, path)) for t in EXPORT_COLUMNS)
+
+
+def version_file(path=ANALYTICS_PATH):
+    return os.path.join(path, 'data_version')
+
+
+def export_version(path=ANALYTICS_PATH):
+    """The DataVersion the export in `path` was written from, None if unknown"""
+    try:
+        with open(version_file(path)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def enabled():
+    """
+    Whether the analytics engine is set and its export is of the database
+    as it is now, so that a project uploaded or deleted since is not
+    missing from or left in the project views
+    """
+    if ANALYTICS_ENGINE != 'duckdb' or not export_exists():
+        return False
+    exported, current = export_version(), models.DataVersion.current(db.engine)
+    if exported != current:
+        if (exported, current) not in STALE_VERSIONS:
+            STALE_VERSIONS.add((exported, current))
+            logger.warning("Analytics export of data version %s is out of date "
+                           "(database at %s), reading the database: run "
+                           "`cli.py export-analytics`", exported, current)
+        return False
+    return True
+
+
+def read_sql(statement):
+    """
+    db.read_sql of `statement`, run by DuckDB over the Parquet export when
+    the analytics engine is enabled
+    """
+    if not enabled():
+        return db.read_sql(statement)
+
+    sql = duckdb_sql(statement)
+    if sql in FAILED_QUERIES:
+        return db.read_sql(statement)
+
+    duckdb = import_duckdb()
+    try:
+        return query_export(statement)
+    except duckdb.Error as e:
+        FAILED_QUERIES.add(sql)
+        logger.warning("Analytics engine failed, reading the database: %s", e)
+        return db.read_sql(statement)
+
+
+def query_export(statement, path=ANALYTICS_PATH):
+    """The result of `statement` run by DuckDB over the export in `path`"""
+    cursor = connection(path).cursor()
+    try:
+        return cursor.execute(duckdb_sql(statement)).df()
+    finally:
+        cursor.close()
+
+
+def duckdb_sql(statement):
+    """`statement` as DuckDB SQL, with its parameters inlined"""
+    return str(statement.compile(dialect=DUCKDB_DIALECT,
+                                 compile_kwargs={'literal_binds': True}))
+
+
+@lru_cache()
+def connection(path=ANALYTICS_PATH):
+    """
+    An in-memory DuckDB database with a view of each exported table. The
+    views read their file on every query, so a refreshed export is seen
+    at once. Each query runs on its own cursor, as connections must not be
+    shared between threads.
+    """
+    duckdb = import_duckdb()
+    con = duckdb.connect()
+    for table in EXPORT_COLUMNS:
+        con.execute(f"CREATE VIEW {table} AS "
+                    f"SELECT * FROM read_parquet('{export_file(table, path)}')")
+    return con
+
+
+def export_parquet(path=ANALYTICS_PATH, bind=None):
+    """
+    Write the EXPORT_COLUMNS of each table of `bind` (the database by
+    default) to a Parquet file in `path`, a chunk at a time. A file
+    replaces the previous export of its table once it is complete, and
+    the DataVersion read before the first one is recorded after the last.
+    """
+    pyarrow = import_pyarrow()
+    os.makedirs(path, exist_ok=True)
+    bind = bind or db.engine
+    models.DataVersion.__table__.create(bind, checkfirst=True)
+    version = models.DataVersion.current(bind)
+    for name, columns in EXPORT_COLUMNS.items():
+        start = time.time()
+        table = db.Base.metadata.tables[name]
+        columns = [table.c[c] for c in columns] if columns else list(table.c)
+        schema = pyarrow.schema([(c.name, arrow_type(c.type)) for c in columns])
+
+        partial_path = f"{export_file(name, path)}.{uuid.uuid4().hex}.part"
+        rows = 0
+        try:
+            with pyarrow.parquet.ParquetWriter(partial_path, schema) as writer:
+                for chunk in db.read_sql_chunks(sa.select(columns), bind=bind):
+                    writer.write_table(pyarrow.Table.from_pandas(
+                        chunk, schema=schema, preserve_index=False))
+                    rows += len(chunk)
+            os.replace(partial_path, export_file(name, path))
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        print(f"Exported {rows} rows of {name} in {time.time() - start:.1f}s")
+
+    partial_path = f"{version_file(path)}.{uuid.uuid4().hex}.part"
+    with open(partial_path, 'w') as f:
+        f.write(str(version))
+    os.replace(partial_path, version_file(path))
+    print(f"Exported data version {version}")
+
+
+def warn_stale_export(path=ANALYTICS_PATH):
+    """Remind that the export, if any, predates a change to the tables"""
+    if export_exists(path):
+        print("The analytics export is now out of date, so the project views "
+              "read the database: run `python cli.py export-analytics` to "
+              "refresh it")
+
+
+def arrow_type(column_type):
+    pyarrow = import_pyarrow()
+    if isinstance(column_type, sa.Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, sa.Float):
+        return pyarrow.float64()
+    if isinstance(column_type, sa.Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, sa.DateTime):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
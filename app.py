@@ -2,6 +2,7 @@ import dash
 import flask
 import os
 
+from db import Session
 from dynamic_downloads import generate_download_file
 
 app = dash.Dash(__name__)
@@ -13,6 +14,12 @@ app.title = "GDSC²"
 STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloads')
 
 
+@server.teardown_appcontext
+def remove_session(exception=None):
+    """Close the request's session and return its connection to the pool"""
+    Session.remove()
+
+
 @server.route('/downloads/<resource>')
 def serve_static(resource):
     return flask.send_from_directory(STATIC_PATH, resource)
@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import click
-from scripts.db_loader import upload_project as up
+import analytics
+from scripts.db_loader import upload_project as up, CMP_API_URL
 from scripts.delete_project import delete_project as dp
+from scripts.validate_upload import validate_project_files
+from scripts.batch_upload import upload_batch as ub
+from scripts import migrations
+from scripts import benchmarks
 
 @click.group()
 def manage():
@@ -11,27 +16,181 @@ def manage():
 
 @manage.command()
 @click.option('--matrix-stats', type=click.Path(exists=True),
-              help='Combo Matrix Statistics File (CSV format)',
+              help='Combo Matrix Statistics File (CSV, CSV.gz, CSV.zst, Parquet or Arrow format)',
               prompt='Matrix Stats File')
-@click.option('--well-stats', help='Combo Well Statistics File (CSV format)',
+@click.option('--well-stats', help='Combo Well Statistics File (CSV, CSV.gz, CSV.zst, Parquet or Arrow format)',
               type=click.Path(exists=True), prompt='Well Stats File')
-@click.option('--nlme-stats', help='NLME Stats File (CSV format)',
+@click.option('--nlme-stats', help='NLME Stats File (CSV, CSV.gz, CSV.zst, Parquet or Arrow format)',
               type=click.Path(exists=True), prompt='NLME Stats File')
 @click.option('--name', '--project-name', prompt='Project Name',
               help='Project Name', required=True)
-def upload_project(matrix_stats, well_stats, nlme_stats, project_name):
+@click.option('--chunksize', type=int, default=None,
+              help='Stream well and NLME stats in chunks of this many rows')
+@click.option('--passports-url', default=CMP_API_URL, show_default=True,
+              help='Cell Model Passports API used to resolve Sanger model IDs')
+@click.option('--append', is_flag=True,
+              help='Only add new or changed plates to an existing project')
+@click.option('--bulk-load', is_flag=True,
+              help='Defer index builds and relax SQLite journaling while '
+                   'loading wells and curves')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Processes used to parse the input files in parallel')
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False),
+              help='Write a JSON report of time, rows and memory per stage to this file')
+@click.option('--dry-run', is_flag=True,
+              help='Only validate the input files, without touching the database')
+def upload_project(matrix_stats, well_stats, nlme_stats, project_name, chunksize,
+                   passports_url, append, bulk_load, workers, profile_path, dry_run):
     """Upload a project"""
+    if dry_run:
+        errors = validate_project_files(matrix_stats, well_stats, nlme_stats)
+        raise SystemExit(1 if errors else 0)
+
     up(combo_matrix_stats_path=matrix_stats, combo_well_stats_path=well_stats,
-       nlme_stats_path=nlme_stats, project_name=project_name)
+       nlme_stats_path=nlme_stats, project_name=project_name,
+       chunksize=chunksize, passports_url=passports_url, append=append,
+       bulk_load=bulk_load, workers=workers, profile_path=profile_path)
+
+
+@manage.command()
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+def upload_batch(manifest):
+    """Upload the projects listed in a YAML manifest"""
+    ub(manifest)
 
 
 @manage.command()
 @click.option('--name', '--project-name', prompt='Project Name',
               help='Project Name', required=True)
-def delete_project(project_name):
+@click.option('--vacuum', is_flag=True,
+              help='Reclaim the space freed in the database file afterwards')
+def delete_project(project_name, vacuum):
     """Delete a project"""
 
-    dp(name=project_name)
+    dp(name=project_name, vacuum=vacuum)
+
+
+@manage.command()
+def create_indexes():
+    """Create the indexes of models.py missing from an existing database"""
+    migrations.create_indexes()
+
+
+@manage.command()
+@click.option('--name', '--project-name', 'project_name',
+              help='Only pack the matrices of this project')
+def pack_matrix_wells(project_name):
+    """Pack the wells of matrices uploaded before well arrays existed"""
+    migrations.backfill_matrix_well_arrays(project_name)
+
+
+@manage.command()
+def add_replicate_groups():
+    """Group the matrices uploaded before replicate groups existed"""
+    migrations.add_replicate_groups()
+
+
+@manage.command()
+def encode_well_labels():
+    """Store the tags and doses of existing well tables by id"""
+    migrations.encode_well_labels()
+
+
+@manage.command()
+def enable_wal():
+    """Switch a SQLite database to WAL journaling for the read only workers"""
+    migrations.enable_wal()
+
+
+@manage.command()
+def export_analytics():
+    """Export the tables of the project views to Parquet for DuckDB"""
+    analytics.export_parquet()
+
+
+@manage.command()
+def check_query_plans():
+    """Check that the matrix page lookups use an index"""
+    if migrations.check_query_plans():
+        raise SystemExit(1)
+
+
+@manage.command()
+@click.option('--matrix-stats', type=click.Path(exists=True), required=True,
+              help='Combo Matrix Statistics File (CSV format)')
+@click.option('--well-stats', type=click.Path(exists=True), required=True,
+              help='Combo Well Statistics File (CSV format)')
+@click.option('--nlme-stats', type=click.Path(exists=True), required=True,
+              help='NLME Stats File (CSV format)')
+def benchmark_input_formats(matrix_stats, well_stats, nlme_stats):
+    """Compare CSV and Parquet/Arrow load time and memory"""
+    benchmarks.benchmark_input_formats(matrix_stats, well_stats, nlme_stats)
+
+
+@manage.command()
+@click.option('--batch-size', type=int, default=1000, show_default=True)
+def benchmark_get_new(batch_size):
+    """Time new-row detection as the drugs table grows"""
+    benchmarks.benchmark_get_new(batch_size=batch_size)
+
+
+@manage.command()
+@click.option('--rows', type=int, multiple=True,
+              help='Number of well results to insert (repeatable)')
+def benchmark_inserts(rows):
+    """Compare well result insert throughput of the old and batched paths"""
+    benchmarks.benchmark_inserts(**({'row_counts': rows} if rows else {}))
+
+
+@manage.command()
+@click.option('--url', default='http://localhost:8080', show_default=True,
+              help='Base URL of the running server')
+@click.option('--path', 'paths', multiple=True, required=True,
+              help='Page to request, e.g. /project/<slug> (repeatable)')
+@click.option('--concurrency', type=int, multiple=True,
+              help='Number of concurrent clients (repeatable)')
+@click.option('--requests', 'requests_per_client', type=int, default=10,
+              show_default=True, help='Requests per client at each level')
+def benchmark_page_load(url, paths, concurrency, requests_per_client):
+    """Measure page throughput of a running server as concurrency grows"""
+    benchmarks.benchmark_page_load(
+        url, list(paths), requests_per_client=requests_per_client,
+        **({'concurrency': concurrency} if concurrency else {}))
+
+
+@manage.command()
+@click.option('--pages', type=int, default=50, show_default=True,
+              help='Number of random matrix and combination pages')
+@click.option('--rounds', type=int, default=3, show_default=True)
+def benchmark_serving_mode(pages, rounds):
+    """Time page queries with and without the read-optimized connections"""
+    benchmarks.benchmark_serving_mode(pages=pages, rounds=rounds)
+
+
+@manage.command()
+@click.option('--path', 'paths', multiple=True, required=True,
+              help='Matrix page to render, e.g. /matrix/<barcode>/<cmatrix> (repeatable)')
+@click.option('--rounds', type=int, default=3, show_default=True)
+@click.option('--max-statements', type=int,
+              help='Exit with an error if a render runs more SQL statements')
+def benchmark_matrix_page(paths, rounds, max_statements):
+    """Count the SQL statements and time of matrix page renders"""
+    results = benchmarks.benchmark_matrix_page(list(paths), rounds=rounds)
+    if max_statements is not None and (results.statements > max_statements).any():
+        print(f"More than {max_statements} statements per render")
+        raise SystemExit(1)
+
+
+@manage.command()
+@click.option('--matrices', type=int, multiple=True,
+              help='Number of matrices of the synthetic project (repeatable)')
+@click.option('--wells', type=int, default=1000000, show_default=True,
+              help='Number of well results')
+@click.option('--rounds', type=int, default=3, show_default=True)
+def benchmark_analytics(matrices, wells, rounds):
+    """Compare project view query latency on SQLite and DuckDB"""
+    benchmarks.benchmark_analytics(wells=wells, rounds=rounds,
+                                   **({'matrix_counts': matrices} if matrices else {}))
 
 
 if __name__ == '__main__':
@@ -6,6 +6,9 @@ import dash_html_components as html
 
 from utils import Colors as C
 
+# Default of day1_viability: look it up from the curve's first matrix
+FROM_CURVE = object()
+
 
 class DoseResponsePlot:
 
@@ -23,17 +26,26 @@ class DoseResponsePlot:
                  label_day1=True,
                  style={},
                  width=None,
-                 height=None):
+                 height=None,
+                 datapoints=None,
+                 day1_viability=FROM_CURVE):
+        """
+        `datapoints` (the single agent wells of the curve) and
+        `day1_viability` can be given when they are already loaded, e.g.
+        by utils.MatrixPageBundle, otherwise they are queried from `curve`.
+        """
         self.curve = curve
 
         self.plot_data = pd.DataFrame({'xfit': np.linspace(-10, 30, 25)})
         self.plot_data['conc_fit'] = curve.x_to_conc(self.plot_data.xfit)
         self.plot_data['nlme_model'] = curve.nlme_model(self.plot_data.xfit)
 
-        self.datapoints = pd.DataFrame(
-            [w.to_dict() for w in curve.well_results]
-        )
-        self.datapoints['viability'] = 1 - self.datapoints.inhibition
+        if datapoints is None:
+            datapoints = pd.DataFrame([w.to_dict() for w in curve.well_results])
+        self.datapoints = datapoints.assign(viability=lambda df: 1 - df.inhibition)
+        if day1_viability is FROM_CURVE:
+            day1_viability = curve.matrix_results[0].day1_viability_mean
+        self.day1_viability = day1_viability
         self.id = f'dose-response-{curve.id}'
         self.display_datapoints = display_datapoints
         self.display_screening_range = display_screening_range
@@ -163,7 +175,7 @@ class DoseResponsePlot:
         shapes.extend([self.maxe_line] if self.mark_maxe else [])
         shapes.extend([self.ic50_line] if self.mark_ic50 else [])
         shapes.extend([self.screening_range] if self.display_screening_range else [])
-        shapes.extend([self.day1_line] if self.mark_day1 and self.curve.matrix_results[0].day1_viability_mean is not None else [])
+        shapes.extend([self.day1_line] if self.mark_day1 and self.day1_viability is not None else [])
         return shapes
 
 
@@ -218,9 +230,9 @@ class DoseResponsePlot:
             'type': 'line',
             'xref': 'paper',
             'x0': 0,
-            'y0': 1 - self.curve.matrix_results[0].day1_viability_mean,
+            'y0': 1 - self.day1_viability,
             'x1': 1,
-            'y1': 1 - self.curve.matrix_results[0].day1_viability_mean,
+            'y1': 1 - self.day1_viability,
             'line': {
                 'color': C.DARKPINK,
                 'width': 1,
@@ -234,7 +246,7 @@ class DoseResponsePlot:
         annotations.extend([self.ic50_label] if self.label_ic50 else [])
         annotations.extend([self.maxe_label] if self.label_maxe else [])
         annotations.extend([self.rmse_label] if self.label_rmse else [])
-        annotations.extend([self.day1_label] if (self.label_day1 and self.curve.matrix_results[0].day1_viability_mean is not None) else [])
+        annotations.extend([self.day1_label] if (self.label_day1 and self.day1_viability is not None) else [])
         return annotations
 
     @property
@@ -314,10 +326,10 @@ class DoseResponsePlot:
     def day1_label(self):
         return dict(
             x=1,
-            y=1 - self.curve.matrix_results[0].day1_viability_mean,
+            y=1 - self.day1_viability,
             xref='paper',
             yref='y',
-            text=f'<b>Day 1 </b> {round(1 - self.curve.matrix_results[0].day1_viability_mean, 3)}',
+            text=f'<b>Day 1 </b> {round(1 - self.day1_viability, 3)}',
             showarrow=False,
             xanchor="right",
             yanchor="top",
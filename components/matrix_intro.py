@@ -15,14 +15,15 @@ from db import session
 from models import Model
 
 
-def layout(matrix):
-    curve1, curve2 = matrix.single_agent_curves
+def layout(bundle):
+    matrix = bundle.matrix
+    curve1, curve2 = bundle.curves
     drug1 = matrix.combination.lib1
     drug2 = matrix.combination.lib2
     model = matrix.model
 
-    max_hsa = max([w.hsa_excess for w in matrix.well_results])
-    max_bliss = max([w.bliss_excess for w in matrix.well_results])
+    max_hsa = bundle.wells.hsa_excess.max()
+    max_bliss = bundle.wells.bliss_excess.max()
 
     return html.Div([
         dbc.Row(className="mt-3 mb-2 pl-3", children=
@@ -63,7 +64,9 @@ def layout(matrix):
                             className="bg-white pt-4 px-4 pb-1 border h-100 shadow-sm",
                             children=[
                                 infoblock(drug1, rmse=curve1.rmse),
-                                curve1.plot(height=250)
+                                curve1.plot(height=250,
+                                         datapoints=bundle.datapoints[curve1.id],
+                                         day1_viability=bundle.day1_viability[curve1.id])
                             ]
                         ),
                     ),
@@ -73,7 +76,9 @@ def layout(matrix):
                             className="bg-white pt-4 px-4 pb-1 border h-100 shadow-sm",
                             children=[
                                 infoblock(drug2, rmse=curve2.rmse),
-                                curve2.plot(height=250)
+                                curve2.plot(height=250,
+                                         datapoints=bundle.datapoints[curve2.id],
+                                         day1_viability=bundle.day1_viability[curve2.id])
                             ]
                         )
                     )
@@ -117,9 +122,10 @@ def layout(matrix):
                          children=[
                              html.H3("Quick Navigation"),
                              html.Hr(),
-                             replicate_links_from_matrix(matrix),
+                             replicate_links_from_matrix(matrix, bundle.replicates),
                              model_links_from_matrix(matrix),
-                             combo_links_from_matrix(matrix)
+                             combo_links_from_matrix(matrix, bundle.model_matrices,
+                                                     bundle.replicates)
                          ])
             ])
         ]),
@@ -2,12 +2,14 @@ import dash_core_components as dcc
 import dash_html_components as html
 
 
-def replicate_links_from_matrix(matrix):
+def replicate_links_from_matrix(matrix, replicates=None):
+    if replicates is None:
+        replicates = matrix.all_replicates
 
     link_text = lambda x: f"Barcode {x.barcode} ({x.project.name}) {'*' if x.hsa_matrix > 0 else ''}"
 
     children = []
-    for rep in sorted(matrix.all_replicates, key=lambda x: x.barcode):
+    for rep in sorted(replicates, key=lambda x: x.barcode):
         if rep != matrix:
             children.append(dcc.Link(link_text(rep), href=f"/matrix/{rep.barcode}/{rep.cmatrix}"))
             children.append((html.Br()))
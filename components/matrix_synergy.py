@@ -4,27 +4,23 @@ import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
-import pandas as pd
 import numpy as np
 import plotly.graph_objs as go
 
 from components.synergy_info.syn_info import infoblock_matrix
 
 from app import app
-from db import session
-from models import WellResult
 from utils import get_metric_axis_range, well_metrics, synergy_colorscale, \
-    get_matrix_from_url, float_formatter
+    get_matrix_from_url, get_matrix_wells, float_formatter
 
 
-def layout(matrix):
+def layout(bundle):
+    matrix = bundle.matrix
 
     drug1 = matrix.combination.lib1.name
     drug2 = matrix.combination.lib2.name
 
-    matrix_df = pd.DataFrame([w.to_dict() for w in matrix.well_results])
-
-    matrix_df = matrix_df.assign(viability=lambda df: 1 - df.inhibition)
+    matrix_df = bundle.wells.assign(viability=lambda df: 1 - df.inhibition)
     matrix_df = matrix_df[['lib1_conc', 'lib2_conc'] + list(well_metrics.keys())]
 
     return dbc.Row(
@@ -69,10 +65,8 @@ def layout(matrix):
 def get_synergy_matrix_from_url(pathname):
     matrix = get_matrix_from_url(pathname)
 
-    well_query = matrix.well_results
-    matrix_df = pd.read_sql(well_query.statement, session.bind)
-    matrix_df['viability'] = 1 - matrix_df.inhibition
-    return matrix_df
+    matrix_df = get_matrix_wells(matrix.barcode, matrix.drugset_id, matrix.cmatrix)
+    return matrix_df.assign(viability=lambda df: 1 - df.inhibition)
 
 
 @app.callback(
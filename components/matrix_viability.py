@@ -10,9 +10,9 @@ import plotly.graph_objs as go
 
 from app import app
 from db import session
-from models import SingleAgentWellResult, WellResult
+from models import SingleAgentWellResult, decode_labels
 from utils import inhibition_colorscale, viability_colorscale, get_matrix_from_url, \
-    float_formatter
+    get_matrix_wells, float_formatter
 
 
 def layout():
@@ -63,12 +63,9 @@ def layout():
 def get_viability_matrix_from_url(pathname):
     matrix = get_matrix_from_url(pathname)
 
-    well_query = matrix.well_results.with_entities(
-        WellResult.lib1_conc, WellResult.lib2_conc, WellResult.inhibition
-    )
-    matrix_df = pd.read_sql(well_query.statement, session.bind)
-    matrix_df['viability'] = 1 - matrix_df.inhibition
-    return matrix_df
+    matrix_df = get_matrix_wells(matrix.barcode, matrix.drugset_id, matrix.cmatrix)
+    return matrix_df[['lib1_conc', 'lib2_conc', 'inhibition']]\
+        .assign(viability=lambda df: 1 - df.inhibition)
 
 
 @app.callback(
@@ -208,7 +205,8 @@ def single_agent_heatmap(metric, tag, drug_name, barcode, orientation):
         .filter(SingleAgentWellResult.lib_drug == tag)\
         .filter(SingleAgentWellResult.barcode == barcode)
 
-    lib_df = pd.read_sql(lib_well_result.statement, session.bind)
+    lib_df = decode_labels(SingleAgentWellResult,
+                           pd.read_sql(lib_well_result.statement, session.bind))
     lib_df = lib_df.sort_values('conc')
     lib_df.conc = [np.round(conc, 4) for conc in lib_df.conc]
 
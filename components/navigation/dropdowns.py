@@ -73,15 +73,17 @@ def get_unique_models_from_matrices_query(matrices_query):
         .sort_values('cell_line_name')
 
 
-def combo_links_from_matrix(matrix):
-
-    other_combos = session.query(MatrixResult)\
-        .filter(MatrixResult.model_id == matrix.model_id)\
-        .order_by(MatrixResult.barcode.desc())\
-        .all()
+def combo_links_from_matrix(matrix, other_combos=None, replicates=None):
+    if other_combos is None:
+        other_combos = session.query(MatrixResult)\
+            .filter(MatrixResult.model_id == matrix.model_id)\
+            .order_by(MatrixResult.barcode.desc())\
+            .all()
+    if replicates is None:
+        replicates = matrix.all_replicates
 
     dropdown_items = {f"{c.combination.lib1.name} + {c.combination.lib2.name}": f"{c.barcode}__{c.cmatrix}"
-                      for c in other_combos if c not in matrix.all_replicates}
+                      for c in other_combos if c not in replicates}
 
     return generate_combos_dropdown(dropdown_items)
 
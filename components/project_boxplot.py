@@ -6,9 +6,10 @@ import dash_core_components as dcc
 import pandas as pd
 import plotly.graph_objs as go
 
+from analytics import read_sql
 from app import app
 from db import session
-from models import MatrixResult, Model
+from models import MatrixResult, Model, Drug
 from utils import matrix_metrics, get_all_tissues, get_all_cancer_types, matrix_hover_label
 
 
@@ -88,10 +89,9 @@ def cached_get_boxplot_summary_data(boxplot_value, project_id, tissue, cancertyp
         all_matrices_query = all_matrices_query\
             .filter(Model.cancer_type.in_(cancertype))
 
-    summary = pd.read_sql(all_matrices_query.statement,
-                          all_matrices_query.session.bind)
+    summary = read_sql(all_matrices_query.statement)
 
-    all_drugs = pd.read_sql_table('drugs', session.bind)
+    all_drugs = read_sql(Drug.__table__.select())
 
     summary = summary.merge(all_drugs, left_on='lib1_id', right_on='id') \
         .merge(all_drugs, left_on='lib2_id', right_on='id',
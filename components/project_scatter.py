@@ -9,9 +9,10 @@ import plotly.graph_objs as go
 import sqlalchemy as sa
 from sqlalchemy import and_, or_
 
+from analytics import read_sql
 from app import app
 from db import session
-from models import MatrixResult, Project, Combination, Model
+from models import MatrixResult, Project, Combination, Model, Drug
 from utils import plot_colors,  matrix_metrics, get_all_tissues, get_all_cancer_types, matrix_hover_label
 
 
@@ -156,10 +157,9 @@ def cached_update_scatter(x_axis_field, y_axis_field, color_field, tissues, canc
 
         all_matrices_query = all_matrices_query .filter(or_(*rules))
 
-    summary = pd.read_sql(all_matrices_query.statement,
-                          all_matrices_query.session.bind)
+    summary = read_sql(all_matrices_query.statement)
 
-    all_drugs = pd.read_sql_table('drugs', session.bind)
+    all_drugs = read_sql(Drug.__table__.select())
 
     summary = summary.merge(all_drugs, left_on='lib1_id', right_on='id') \
         .merge(all_drugs, left_on='lib2_id', right_on='id',
@@ -1,5 +1,3 @@
-from functools import lru_cache
-
 import dash_html_components as html
 
 from utils import get_combination_matrices_summary
@@ -14,7 +12,6 @@ def get_badge_classname(value, context, metric):
         return 'badge-success'
 
 
-@lru_cache()
 def get_context(matrix):
     return get_combination_matrices_summary(
         matrix.project_id, matrix.lib1_id, matrix.lib2_id,
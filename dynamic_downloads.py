@@ -1,11 +1,15 @@
-from flask import abort
+import gzip
+import os
+import uuid
+
 import pandas as pd
+from flask import abort
 from sqlalchemy import and_
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm.exc import NoResultFound
-from db import session
+from db import engine, session, read_sql_chunks
 from models import Project, MatrixResult, Drug, Model, Combination, WellResult, \
-    DoseResponseCurve
+    DoseResponseCurve, decode_labels
 
 
 def generate_download_file(project_slug, download_type):
@@ -24,12 +28,16 @@ def generate_well_results(project_slug):
         return abort(404)
 
     query = session.query(Project, MatrixResult, WellResult, Combination, Model) \
-        .join(MatrixResult)\
-        .join(WellResult).join(Combination, MatrixResult.combination).join(Model) \
+        .join(MatrixResult, Project.id == MatrixResult.project_id) \
+        .join(WellResult, and_(MatrixResult.barcode == WellResult.barcode,
+                               MatrixResult.drugset_id == WellResult.drugset_id,
+                               MatrixResult.cmatrix == WellResult.cmatrix)) \
+        .join(Combination, MatrixResult.combination) \
+        .join(Model, MatrixResult.model_id == Model.id) \
         .filter(Project.slug == project_slug)
-    df = pd.read_sql(query.statement, session.get_bind())
-    df.to_csv(STATIC_PATH + f"/{project_slug}_well_results.csv.gz",
-              compression='gzip', index=False)
+    write_csv_gz(query.statement,
+                 STATIC_PATH + f"/{project_slug}_well_results.csv.gz",
+                 decode=WellResult)
 
     return True
 
@@ -82,9 +90,7 @@ def generate_matrix_results(project_slug):
                        MatrixResult.day1_viability_mean,
                        MatrixResult.day1_inhibition_scale, MatrixResult.growth_rate,
                        MatrixResult.doubling_time)
-    df = pd.read_sql(query.statement, session.get_bind())
-
-    df.columns = \
+    columns = \
         ["BARCODE", "DRUGSET_ID", "cmatrix", "CELL_LINE_NAME", "MASTER_CELL_ID",
          "COSMIC_ID", "SIDM", "TISSUE", "CANCER_TYPE",
          "lib1_tag", "lib1_ID", "lib1_name", "lib1_minc", "lib1_maxc", "lib1_RMSE", "lib1_MaxE",
@@ -99,7 +105,34 @@ def generate_matrix_results(project_slug):
          "HSA_window_dose2", "HSA_window_SO", "HSA_window_SO_dose1",
          "HSA_window_SO_dose2", "day1_intensity_mean", "day1_viability_mean", "day1_inhibition_scale",
          "growth_rate", "doubling_time"]
-    df.to_csv(STATIC_PATH + f"/{project_slug}_matrix_results.csv.gz",
-              compression='gzip', index=False)
+    write_csv_gz(query.statement,
+                 STATIC_PATH + f"/{project_slug}_matrix_results.csv.gz",
+                 columns=columns)
+
+    return True
+
+def write_csv_gz(statement, path, columns=None, decode=None):
+    """
+    Write the result of `statement` to a gzipped CSV file a chunk at a
+    time, under a temporary name until it is complete so that a concurrent
+    request never serves part of it. `columns` renames the result columns.
+    The label ids of the model `decode` are written as their labels.
+    """
+    partial_path = f"{path}.{uuid.uuid4().hex}.part"
+
+    def write(f, chunk, header):
+        if decode is not None:
+            chunk = decode_labels(decode, chunk, replace=True)
+        if columns is not None:
+            chunk.columns = columns
+        chunk.to_csv(f, header=header, index=False)
 
-    return True
\ No newline at end of file
+    with gzip.open(partial_path, 'wt') as f:
+        header = True
+        for chunk in read_sql_chunks(statement):
+            write(f, chunk, header)
+            header = False
+        if header:
+            # no rows, but the header is still wanted
+            write(f, pd.read_sql(statement, engine), header)
+    os.replace(partial_path, path)
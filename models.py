@@ -1,7 +1,9 @@
 import sqlalchemy as sa
 import numpy as np
-from sqlalchemy.ext.hybrid import hybrid_property
+import pandas as pd
+from sqlalchemy.ext.hybrid import hybrid_property, Comparator
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import operators
 from sqlalchemy_utils import generic_repr
 
 from components.dr_plot import DoseResponsePlot
@@ -10,8 +12,9 @@ from db import Base, session
 
 class ToDictMixin:
     def to_dict(obj):
-        return {c.key: getattr(obj, c.key)
-                for c in sa.inspection.inspect(obj).mapper.column_attrs}
+        columns = [c.key for c in sa.inspection.inspect(obj).mapper.column_attrs]
+        labels = [name for name, _, _ in label_properties(type(obj))]
+        return {key: getattr(obj, key) for key in columns + labels}
 
 
 @generic_repr
@@ -126,6 +129,11 @@ class MatrixResult(ToDictMixin, Base):
                          index=True)
     project_id = sa.Column(sa.Integer, sa.ForeignKey(Project.id),
                            nullable=False, index=True)
+    # The same for all replicates of the matrix, across projects: see
+    # replicate_group_of. Set on upload; databases created before it
+    # existed need `cli.py add-replicate-groups`, until which replicates
+    # are looked up by their drugs and model instead.
+    replicate_group = sa.Column(sa.String, index=True)
 
     hsa_synergistic_wells = sa.Column(sa.Integer)
     hsa_matrix = sa.Column(sa.Float)
@@ -204,20 +212,35 @@ class MatrixResult(ToDictMixin, Base):
         return self.project_replicates_query.all()
 
 
+    @staticmethod
+    def replicate_group_of(lib1_id, lib2_id, model_id):
+        """
+        The replicate groups of the matrices whose drugs and models are in
+        the Series `lib1_id`, `lib2_id` and `model_id`: the unordered drug
+        pair plus the model, e.g. '1011+1373:SIDM00003'
+        """
+        first = np.minimum(lib1_id, lib2_id).astype(str)
+        second = np.maximum(lib1_id, lib2_id).astype(str)
+        return first + '+' + second + ':' + model_id.astype(str)
+
     @property
     def all_replicates_query(self):
-        subq = self.combination.replicates_query.subquery()
-        al_reps = sa.orm.aliased(Combination, subq)
-
-        return sa.orm.object_session(self).query(MatrixResult)\
-            .join(Combination) \
-            .filter(
-                sa.and_(
-                    Combination.project_id == al_reps.project_id,
-                    Combination.lib1_id == al_reps.lib1_id,
-                    Combination.lib2_id == al_reps.lib2_id
-                ))\
-            .filter(MatrixResult.model_id == self.model_id)
+        """
+        The matrices of the same model and drugs, in either order, in all
+        projects, with their projects loaded
+        """
+        query = sa.orm.object_session(self).query(MatrixResult)\
+            .options(sa.orm.joinedload(MatrixResult.project))
+        if self.replicate_group is None:
+            # Not yet set by `cli.py add-replicate-groups`
+            return query\
+                .filter(MatrixResult.model_id == self.model_id)\
+                .filter(sa.or_(
+                    sa.and_(MatrixResult.lib1_id == self.lib1_id,
+                            MatrixResult.lib2_id == self.lib2_id),
+                    sa.and_(MatrixResult.lib1_id == self.lib2_id,
+                            MatrixResult.lib2_id == self.lib1_id)))
+        return query.filter(MatrixResult.replicate_group == self.replicate_group)
 
     @property
     def all_replicates(self):
@@ -230,6 +253,107 @@ class MatrixResult(ToDictMixin, Base):
     )
 
 
+@generic_repr
+class WellTag(Base):
+    """The drug tags of the well tables, which store them by id"""
+    __tablename__ = 'well_tags'
+    id = sa.Column(sa.Integer, primary_key=True)
+    label = sa.Column(sa.String, nullable=False, unique=True)
+
+
+@generic_repr
+class WellDose(Base):
+    """The doses (D1 to D7...) of the well tables, which store them by id"""
+    __tablename__ = 'well_doses'
+    id = sa.Column(sa.Integer, primary_key=True)
+    label = sa.Column(sa.String, nullable=False, unique=True)
+
+
+# The labels of each lookup (WellTag or WellDose) by id, read once per
+# worker and again only when an id is missing: ids never change
+LABELS = {}
+
+
+def lookup_labels(lookup, ids=()):
+    """The labels of `lookup` by id, read again if any of `ids` is missing"""
+    labels = LABELS.get(lookup)
+    if labels is None or not set(ids) <= labels.keys():
+        labels = LABELS[lookup] = dict(session.query(lookup.id, lookup.label).all())
+    return labels
+
+
+class LabelComparator(Comparator):
+    """
+    Compares a label_property through its id column, so that filtering on
+    a label looks its id up once and uses the indexes on the ids
+    """
+
+    def __init__(self, expression, lookup, id_column):
+        super().__init__(expression)
+        self.lookup, self.id_column = lookup, id_column
+
+    def operate(self, op, *other, **kwargs):
+        if op is operators.eq:
+            return self.id_column == sa.select([self.lookup.id])\
+                .where(self.lookup.label == other[0]).as_scalar()
+        if op is operators.in_op:
+            return self.id_column.in_(sa.select([self.lookup.id])
+                                      .where(self.lookup.label.in_(other[0])))
+        return super().operate(op, *other, **kwargs)
+
+
+def label_property(lookup, id_column, name):
+    """
+    The label in `lookup` (WellTag or WellDose) of the id in `id_column`.
+    Rows are loaded with the id only: instances decode it through
+    lookup_labels, DataFrames with decode_labels.
+    """
+    def fget(self):
+        id_key = sa.inspect(type(self)).get_property_by_column(id_column).key
+        label_id = getattr(self, id_key)
+        if label_id is None:
+            return None
+        return lookup_labels(lookup, [label_id])[label_id]
+    fget.__name__ = name
+
+    def comparator(cls):
+        expression = sa.select([lookup.label]).where(lookup.id == id_column)\
+            .correlate_except(lookup.__table__).as_scalar().label(name)
+        return LabelComparator(expression, lookup, id_column)
+
+    prop = hybrid_property(fget, custom_comparator=comparator)
+    prop.info.update(lookup=lookup, id_column=id_column)
+    return prop
+
+
+def label_properties(model):
+    """The label_property names of `model`, with their id column names and lookups"""
+    return [(key, prop.info['id_column'].key, prop.info['lookup'])
+            for key, prop in sa.inspect(model).all_orm_descriptors.items()
+            if isinstance(prop, hybrid_property) and 'lookup' in prop.info]
+
+
+def decode_labels(model, df, replace=False):
+    """
+    `df`, rows of `model`, with the label of each id column it has. With
+    `replace` the labels take the place of their id columns, as the rows
+    were stored before the ids.
+    """
+    decoded = df.copy()
+    for name, id_column, lookup in label_properties(model):
+        if id_column in df.columns:
+            ids = df[id_column]
+            labels = ids.map(lookup_labels(lookup, ids.dropna().unique().tolist()))
+            if replace:
+                position = decoded.columns.get_loc(id_column)
+                del decoded[id_column]
+                # a query of several models can already have a `name` column
+                decoded.insert(position, name, labels, allow_duplicates=True)
+            else:
+                decoded[name] = labels
+    return decoded
+
+
 @generic_repr
 class WellResult(ToDictMixin, Base):
     __tablename__ = 'well_results'
@@ -238,11 +362,11 @@ class WellResult(ToDictMixin, Base):
     drugset_id = sa.Column(sa.Integer, nullable=False)
     cmatrix = sa.Column(sa.Integer, nullable=False)
     position = sa.Column(sa.Integer, nullable=False)
-    lib1_tag = sa.Column(sa.String, nullable=False)
-    lib1_dose = sa.Column(sa.String, nullable=False)
+    lib1_tag_id = sa.Column(sa.Integer, sa.ForeignKey(WellTag.id), nullable=False)
+    lib1_dose_id = sa.Column(sa.Integer, sa.ForeignKey(WellDose.id), nullable=False)
     lib1_conc = sa.Column(sa.Float, nullable=False)
-    lib2_tag = sa.Column(sa.String, nullable=False)
-    lib2_dose = sa.Column(sa.String, nullable=False)
+    lib2_tag_id = sa.Column(sa.Integer, sa.ForeignKey(WellTag.id), nullable=False)
+    lib2_dose_id = sa.Column(sa.Integer, sa.ForeignKey(WellDose.id), nullable=False)
     lib2_conc = sa.Column(sa.Float, nullable=False)
     inhibition = sa.Column(sa.Float)
     hsa = sa.Column(sa.Float)
@@ -250,27 +374,115 @@ class WellResult(ToDictMixin, Base):
     bliss_additivity = sa.Column(sa.Float)
     bliss_excess = sa.Column(sa.Float)
 
+    # Tags and doses are repeated on every well, so they are stored by id
+    lib1_tag = label_property(WellTag, lib1_tag_id, 'lib1_tag')
+    lib1_dose = label_property(WellDose, lib1_dose_id, 'lib1_dose')
+    lib2_tag = label_property(WellTag, lib2_tag_id, 'lib2_tag')
+    lib2_dose = label_property(WellDose, lib2_dose_id, 'lib2_dose')
+
     matrix_result = relationship("MatrixResult", back_populates='well_results')
 
     __table_args__ = (sa.ForeignKeyConstraint(
         [drugset_id, cmatrix, barcode],
         [MatrixResult.drugset_id, MatrixResult.cmatrix, MatrixResult.barcode]),
+                      sa.Index('ix_well_results_barcode_drugset_id_cmatrix',
+                               barcode, drugset_id, cmatrix),
                       {}
     )
 
 
+@generic_repr
+class MatrixWellArray(Base):
+    """
+    The well results of a matrix packed into one blob, so that a matrix
+    page reads a single row instead of a WellResult per well.
+
+    The blob holds, as little-endian arrays: a uint32 header (format
+    version, number of lib1 and lib2 concentrations), the float64 lib1 and
+    lib2 concentration axes, a uint8 grid flagging the wells present, and
+    a float64 grid of each of METRICS, with lib2 along the rows.
+    """
+    __tablename__ = 'matrix_well_arrays'
+    barcode = sa.Column(sa.Integer, primary_key=True)
+    drugset_id = sa.Column(sa.Integer, primary_key=True)
+    cmatrix = sa.Column(sa.Integer, primary_key=True)
+    data = sa.Column(sa.LargeBinary, nullable=False)
+
+    VERSION = 1
+    METRICS = ['inhibition', 'hsa', 'hsa_excess', 'bliss_additivity', 'bliss_excess']
+
+    __table_args__ = (sa.ForeignKeyConstraint(
+        [drugset_id, cmatrix, barcode],
+        [MatrixResult.drugset_id, MatrixResult.cmatrix, MatrixResult.barcode]), {}
+    )
+
+    @classmethod
+    def pack(cls, wells):
+        """
+        Pack a DataFrame of the well results of one matrix, with lib1_conc,
+        lib2_conc and METRICS columns. Returns None if the wells do not
+        form a grid, i.e. two of them share both concentrations.
+        """
+        if wells.duplicated(['lib1_conc', 'lib2_conc']).any():
+            return None
+        lib1_conc = np.sort(wells.lib1_conc.unique())
+        lib2_conc = np.sort(wells.lib2_conc.unique())
+        rows = np.searchsorted(lib2_conc, wells.lib2_conc.values)
+        cols = np.searchsorted(lib1_conc, wells.lib1_conc.values)
+
+        present = np.zeros((len(lib2_conc), len(lib1_conc)), dtype='<u1')
+        present[rows, cols] = 1
+        parts = [np.array([cls.VERSION, len(lib1_conc), len(lib2_conc)], dtype='<u4'),
+                 lib1_conc.astype('<f8'), lib2_conc.astype('<f8'), present]
+        for metric in cls.METRICS:
+            grid = np.full(present.shape, np.nan, dtype='<f8')
+            grid[rows, cols] = wells[metric].astype(float).values
+            parts.append(grid)
+        return b''.join(part.tobytes() for part in parts)
+
+    @classmethod
+    def unpack(cls, data):
+        """The well results packed in `data`, as a DataFrame with one row per well"""
+        version, n1, n2 = (int(i) for i in np.frombuffer(data, dtype='<u4', count=3))
+        if version != cls.VERSION:
+            raise ValueError(f"Unknown matrix well array version {version}")
+        offset = 12
+        lib1_conc = np.frombuffer(data, dtype='<f8', count=n1, offset=offset)
+        offset += 8 * n1
+        lib2_conc = np.frombuffer(data, dtype='<f8', count=n2, offset=offset)
+        offset += 8 * n2
+        present = np.frombuffer(data, dtype='<u1', count=n1 * n2, offset=offset) == 1
+        offset += n1 * n2
+
+        wells = {'lib1_conc': np.tile(lib1_conc, n2)[present],
+                 'lib2_conc': np.repeat(lib2_conc, n1)[present]}
+        for metric in cls.METRICS:
+            wells[metric] = np.frombuffer(data, dtype='<f8', count=n1 * n2,
+                                          offset=offset)[present]
+            offset += 8 * n1 * n2
+        return pd.DataFrame(wells, columns=['lib1_conc', 'lib2_conc'] + cls.METRICS)
+
+
 @generic_repr
 class SingleAgentWellResult(ToDictMixin, Base):
     __tablename__ = 'single_agent_well_results'
     id = sa.Column(sa.Integer, primary_key=True)
     barcode = sa.Column(sa.Integer, nullable=False)
     drugset_id = sa.Column(sa.Integer, nullable=False)
-    lib_drug = sa.Column(sa.String, nullable=False)
+    lib_drug_id = sa.Column(sa.Integer, sa.ForeignKey(WellTag.id), nullable=False)
     position = sa.Column(sa.Integer, nullable=False)
     inhibition = sa.Column(sa.Float, nullable=False)
-    dose = sa.Column(sa.String, nullable=True)
+    dose_id = sa.Column(sa.Integer, sa.ForeignKey(WellDose.id), nullable=True)
     conc = sa.Column(sa.Float, nullable=False)
 
+    lib_drug = label_property(WellTag, lib_drug_id, 'lib_drug')
+    dose = label_property(WellDose, dose_id, 'dose')
+
+    __table_args__ = (
+        sa.Index('ix_single_agent_well_results_barcode_lib_drug_id_drugset_id',
+                 barcode, lib_drug_id, drugset_id),
+    )
+
 @generic_repr
 class DoseResponseCurve(ToDictMixin, Base):
     __tablename__ = 'dose_response_curves'
@@ -289,6 +501,10 @@ class DoseResponseCurve(ToDictMixin, Base):
     xmid = sa.Column(sa.Float)
     scal = sa.Column(sa.Float)
 
+    __table_args__ = (
+        sa.Index('ix_dose_response_curves_barcode_tag', barcode, tag),
+    )
+
     @property
     def matrix_results(self):
         return sa.orm.object_session(self).query(MatrixResult) \
@@ -325,3 +541,36 @@ class DoseResponseCurve(ToDictMixin, Base):
 
     def plot(self, *args, **kwargs):
         return DoseResponsePlot(self, *args, **kwargs).plot()
+
+
+@generic_repr
+class UploadCheckpoint(ToDictMixin, Base):
+    __tablename__ = 'upload_checkpoints'
+    project_id = sa.Column(sa.Integer, sa.ForeignKey(Project.id), primary_key=True)
+    stage = sa.Column(sa.String, primary_key=True)
+    completed_at = sa.Column(sa.DateTime, nullable=False)
+
+
+@generic_repr
+class DataVersion(Base):
+    """
+    A count of the uploads and project deletions, increased by each, so
+    that copies of the tables (see analytics.py) can tell they are out of
+    date. The table holds a single row.
+    """
+    __tablename__ = 'data_version'
+    id = sa.Column(sa.Integer, primary_key=True)
+    version = sa.Column(sa.Integer, nullable=False)
+
+    @classmethod
+    def current(cls, bind):
+        """The version of the database `bind`, 0 before any change"""
+        return bind.execute(sa.select([cls.version]).where(cls.id == 1)).scalar() or 0
+
+    @classmethod
+    def increment(cls, session):
+        """Count a change in the current transaction of `session`"""
+        updated = session.execute(cls.__table__.update().where(cls.id == 1)
+                                  .values(version=cls.version + 1)).rowcount
+        if not updated:
+            session.execute(cls.__table__.insert().values(id=1, version=1))
@@ -6,7 +6,7 @@ from components.matrix_intro import layout as intro
 from components.matrix_viability import layout as viability
 from components.matrix_synergy import layout as synergy
 from components.breadcrumbs import breadcrumb_generator as crumbs
-from utils import get_matrix_from_url
+from utils import get_matrix_from_url, MatrixPageBundle
 
 
 def layout(url):
@@ -15,6 +15,8 @@ def layout(url):
     if not isinstance(my_matrix, MatrixResult):
         return my_matrix
 
+    bundle = MatrixPageBundle(my_matrix)
+    my_matrix = bundle.matrix
     p = my_matrix.project
     c = my_matrix.combination
 
@@ -23,7 +25,7 @@ def layout(url):
         crumbs([("Home", "/"), (p.name, f"/project/{p.slug}"),
                 (f"{c.lib1.name} + {c.lib2.name}", f"/project/{p.slug}/combination/{c.lib1_id}+{c.lib2_id}"),
                 (f"{my_matrix.model.cell_line_name}",)]),
-        intro(my_matrix),
+        intro(bundle),
         viability(),
-        synergy(my_matrix),
+        synergy(bundle),
     ])
\ No newline at end of file
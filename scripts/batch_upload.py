@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+!!! Run this program using gdscmatrixexplorer/cli.py !!!
+
+Upload many projects in one process from a YAML manifest:
+
+    defaults:              # optional, applied to every project
+      chunksize: 100000
+      bulk_load: true
+    projects:
+      - name: GDSC_007-A
+        matrix_stats: GDSC_007-A/matrix_stats.csv.gz
+        well_stats: GDSC_007-A/well_stats.csv.gz
+        nlme_stats: GDSC_007-A/nlme_stats.csv.gz
+      - name: GDSC_008-B
+        ...
+        append: true
+
+Relative paths are relative to the manifest. Any `upload_project` option
+(chunksize, passports_url, append, bulk_load, workers, profile_path) can be
+set in the defaults or per project. A profile_path in the defaults is made
+per project, so that the reports do not overwrite each other: `{name}` in
+it is replaced by the project name, or else the name is added before the
+extension, e.g. profile.json becomes profile-GDSC_007-A.json. The projects
+share one ReferenceCache, so models, drugs and SIDMs already seen are not
+looked up again.
+'''
+
+import os
+import time
+
+import yaml
+
+from scripts.db_loader import upload_project, ReferenceCache
+
+
+FILE_OPTIONS = ['matrix_stats', 'well_stats', 'nlme_stats', 'profile_path']
+UPLOAD_OPTIONS = ['chunksize', 'passports_url', 'append', 'bulk_load',
+                  'workers', 'profile_path']
+
+
+def read_manifest(manifest_path):
+    """The list of `upload_project` arguments of every project in the manifest"""
+    with open(manifest_path) as f:
+        manifest = yaml.safe_load(f) or {}
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    defaults = manifest.get('defaults') or {}
+    uploads = []
+    for project in manifest.get('projects') or []:
+        if defaults.get('profile_path') and 'profile_path' not in project:
+            project['profile_path'] = project_profile_path(
+                defaults['profile_path'], project.get('name'))
+        project = dict(defaults, **project)
+        unknown = set(project) - {'name'} - set(FILE_OPTIONS) - set(UPLOAD_OPTIONS)
+        missing = {'name', 'matrix_stats', 'well_stats', 'nlme_stats'} - set(project)
+        if unknown or missing:
+            raise ValueError(f"{manifest_path}: project {project.get('name')} has "
+                             f"unknown keys {sorted(unknown)}, "
+                             f"missing keys {sorted(missing)}")
+        for option in FILE_OPTIONS:
+            if project.get(option):
+                project[option] = os.path.join(base_dir, project[option])
+
+        uploads.append(dict(
+            combo_matrix_stats_path=project['matrix_stats'],
+            combo_well_stats_path=project['well_stats'],
+            nlme_stats_path=project['nlme_stats'],
+            project_name=project['name'],
+            **{o: project[o] for o in UPLOAD_OPTIONS if o in project}))
+
+    if not uploads:
+        raise ValueError(f"{manifest_path}: no projects to upload")
+    return uploads
+
+
+def project_profile_path(profile_path, name):
+    """The default `profile_path` of the project `name`"""
+    if '{name}' in profile_path:
+        return profile_path.replace('{name}', str(name))
+    root, ext = os.path.splitext(profile_path)
+    return f"{root}-{name}{ext}"
+
+
+def upload_batch(manifest_path):
+    """
+    Upload every project of the manifest in order, then print the time and
+    rows written per project and in total. If a project fails, the batch
+    stops; running it again resumes that project from its checkpoints, so
+    the projects uploaded before it should be removed from the manifest or
+    set to `append: true`.
+    """
+    uploads = read_manifest(manifest_path)
+    references = ReferenceCache()
+
+    start = time.time()
+    results = []
+    for i, upload in enumerate(uploads, 1):
+        print(f"=== Project {i}/{len(uploads)}: {upload['project_name']} ===")
+        try:
+            profile = upload_project(references=references, **upload)
+        except Exception:
+            done = [r['project'] for r in results]
+            print(f"Upload of {upload['project_name']} failed, "
+                  f"uploaded before it: {', '.join(done) or 'none'}")
+            raise
+        report = profile.report()
+        results.append(dict(project=upload['project_name'],
+                            seconds=report['seconds'],
+                            rows=sum(s.get('rows_out', 0) for s in report['stages'])))
+
+    seconds = time.time() - start
+    rows = sum(r['rows'] for r in results)
+    print(f"=== Uploaded {len(results)} projects ===")
+    for r in results:
+        print(f"{r['project']}: {r['rows']} rows in {r['seconds']:.1f}s")
+    print(f"Total: {rows} rows in {seconds:.1f}s "
+          f"({rows / max(seconds, 1e-6):.0f} rows/s)")
+    return results
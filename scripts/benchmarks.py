@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+!!! Run this program using gdscmatrixexplorer/cli.py !!!
+
+Benchmarks for the upload and serving code paths.
+'''
+
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import requests
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+import analytics
+import db
+from db import Base, Session, count_statements
+from models import Drug, WellResult, MatrixResult, DoseResponseCurve, \
+    SingleAgentWellResult, Model, Combination, Project
+from scripts import db_loader
+from scripts.db_loader import is_matrix_stats_column, WELL_STATS_COLUMNS, \
+    NLME_CURVE_COLUMNS, NLME_WELL_COLUMNS, MATRIX_STATS_DTYPES, \
+    WELL_STATS_DTYPES, NLME_STATS_DTYPES
+from scripts.input_files import read_input, write_columnar
+
+
+def measure(func, *args, **kwargs):
+    """
+    Run `func` in a fresh process and return its wall time in seconds, the
+    increase in peak RSS in MB and the length of its result.
+    """
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(_measure, func, args, kwargs).result()
+
+
+def _measure(func, args, kwargs):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = func(*args, **kwargs)
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, (rss_after - rss_before) / 1024, len(result)
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+@contextmanager
+def scratch_database():
+    """Point the loader at an empty, temporary SQLite database"""
+    with tempfile.TemporaryDirectory() as tmp:
+        scratch_engine = sa.create_engine(f"sqlite:///{tmp}/benchmark.db")
+        Base.metadata.create_all(scratch_engine)
+        engine, session = db_loader.engine, db_loader.session
+        db_loader.engine = scratch_engine
+        db_loader.session = sessionmaker(bind=scratch_engine)()
+        try:
+            yield scratch_engine
+        finally:
+            db_loader.session.close()
+            db_loader.engine, db_loader.session = engine, session
+            scratch_engine.dispose()
+
+
+def synthetic_drugs(first_id, n):
+    ids = range(first_id, first_id + n)
+    return pd.DataFrame({'id': list(ids),
+                         'name': [f"Drug {i}" for i in ids],
+                         'target': 'Target', 'pathway': 'Pathway',
+                         'owner': 'Owner'})
+
+
+def print_results(results):
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    return results
+
+
+def benchmark_input_formats(matrix_stats, well_stats, nlme_stats,
+                            extensions=('parquet', 'feather')):
+    """
+    Compare load time and peak memory of the project input files as given
+    against Parquet and Arrow IPC copies, reading only the loader's columns
+    with the loader's column types.
+    """
+    inputs = {
+        'matrix_stats': (matrix_stats, is_matrix_stats_column, MATRIX_STATS_DTYPES),
+        'well_stats': (well_stats, WELL_STATS_COLUMNS, WELL_STATS_DTYPES),
+        'nlme_stats': (nlme_stats, NLME_CURVE_COLUMNS + NLME_WELL_COLUMNS,
+                       NLME_STATS_DTYPES),
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (path, usecols, dtype) in inputs.items():
+            copies = {'csv': path}
+            source = read_input(path)
+            for ext in extensions:
+                copies[ext] = os.path.join(tmp, f"{name}.{ext}")
+                write_columnar(source, copies[ext])
+            del source
+
+            for fmt, copy in copies.items():
+                seconds, peak_rss_mb, rows = measure(read_input, copy,
+                                                     usecols=usecols, dtype=dtype)
+                results.append(dict(file=name, format=fmt, rows=rows,
+                                    seconds=seconds, peak_rss_mb=peak_rss_mb,
+                                    size_mb=os.path.getsize(copy) / 1024 ** 2))
+
+    return print_results(results)
+
+
+def benchmark_get_new(table_sizes=(1000, 10000, 100000, 1000000), batch_size=1000):
+    """
+    Time `get_new` for a fixed incoming batch of drugs, half of them already
+    stored, as the drugs table grows. Reading the whole table, which the
+    previous implementation did on every call, is timed for comparison.
+    """
+    results = []
+    with scratch_database() as engine:
+        stored = 0
+        for size in table_sizes:
+            engine.execute(Drug.__table__.insert(),
+                           synthetic_drugs(stored, size - stored).to_dict('records'))
+            stored = size
+
+            incoming = synthetic_drugs(size - batch_size // 2, batch_size)
+            seconds, new = timed(db_loader.get_new, Drug, incoming)
+            full_read_seconds, _ = timed(pd.read_sql, Drug.__table__.select(), engine)
+            results.append(dict(table_rows=size, batch_rows=batch_size,
+                                new_rows=len(new), seconds=seconds,
+                                full_table_read_seconds=full_read_seconds))
+
+    return print_results(results)
+
+
+def synthetic_well_results(n):
+    """`n` well results of 7x7 matrices, as `extract_well_results` returns them"""
+    rng = np.random.RandomState(0)
+    position = np.arange(n) % 49
+    doses = pd.Categorical([f"D{i}" for i in range(1, 8)])
+    return pd.DataFrame({
+        'drugset_id': 1,
+        'cmatrix': (np.arange(n) // 49 % 12 + 1).astype('int16'),
+        'barcode': (np.arange(n) // (49 * 12)).astype('int32'),
+        'position': (position + 101).astype('int16'),
+        'lib1_tag': pd.Categorical(['L1001'] * n),
+        'lib1_dose': doses.take(position // 7),
+        'lib1_conc': 0.01 * (position // 7 + 1),
+        'lib2_tag': pd.Categorical(['L1002'] * n),
+        'lib2_dose': doses.take(position % 7),
+        'lib2_conc': 0.02 * (position % 7 + 1),
+        'inhibition': rng.rand(n),
+        'hsa': rng.rand(n),
+        'hsa_excess': rng.rand(n),
+        'bliss_additivity': rng.rand(n),
+        'bliss_excess': rng.rand(n),
+    })
+
+
+def insert_records(model, df):
+    """The previous `to_db` insert: one dict per row, in a single execute"""
+    db_loader.engine.execute(model.__table__.insert(),
+                             df.drop_duplicates().to_dict('records'))
+    return range(len(df))
+
+
+def insert_batches(model, df):
+    return range(db_loader.insert_rows(model, df))
+
+
+def benchmark_inserts(row_counts=(10000, 100000, 1000000)):
+    """
+    Compare insert throughput and peak memory of well results through the
+    previous list-of-dicts insert and through `insert_rows`.
+    """
+    results = []
+    with scratch_database() as engine:
+        for n in row_counts:
+            wells = db_loader.encode_labels(WellResult, synthetic_well_results(n))
+            for name, insert in (('dicts', insert_records),
+                                 ('batched tuples', insert_batches)):
+                engine.execute(WellResult.__table__.delete())
+                seconds, peak_rss_mb, rows = measure(insert, WellResult, wells)
+                results.append(dict(rows=rows, path=name, seconds=seconds,
+                                    rows_per_second=rows / seconds,
+                                    peak_rss_mb=peak_rss_mb))
+
+    return print_results(results)
+
+
+def request_page(http, base_url, path):
+    """Render `path` through the page-content callback, as the browser does"""
+    start = time.time()
+    response = http.post(f"{base_url}/_dash-update-component", json={
+        'output': 'page-content.children',
+        'inputs': [{'id': 'url', 'property': 'pathname', 'value': path}],
+    })
+    response.raise_for_status()
+    return time.time() - start
+
+
+def benchmark_page_load(base_url, paths, concurrency=(1, 2, 4, 8, 16),
+                        requests_per_client=10):
+    """
+    Load test a running server: render `paths` in turn from 1, 2, 4...
+    concurrent clients and report requests per second and latency at each
+    level. Throughput should grow with the clients up to the worker count.
+    Basic auth credentials are read from MATRIXEXPLORER_USER and
+    MATRIXEXPLORER_PASSWD.
+    """
+    http = requests.Session()
+    http.auth = (os.getenv('MATRIXEXPLORER_USER'), os.getenv('MATRIXEXPLORER_PASSWD'))
+    base_url = base_url.rstrip('/')
+    for path in paths:
+        # warm the per-process caches, so that every level sees them alike
+        request_page(http, base_url, path)
+
+    results = []
+    for clients in concurrency:
+        n = clients * requests_per_client
+        urls = [paths[i % len(paths)] for i in range(n)]
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            start = time.time()
+            latencies = list(pool.map(
+                lambda path: request_page(http, base_url, path), urls))
+            seconds = time.time() - start
+        results.append(dict(clients=clients, requests=n, seconds=seconds,
+                            requests_per_second=n / seconds,
+                            mean_latency=np.mean(latencies),
+                            p95_latency=np.percentile(latencies, 95)))
+
+    return print_results(results)
+
+
+def matrix_page_queries(m):
+    """The statements the matrix page of matrix result `m` runs"""
+    tags = [m.lib1_tag, m.lib2_tag]
+    return [
+        MatrixResult.__table__.select().where(sa.and_(
+            MatrixResult.barcode == m.barcode, MatrixResult.cmatrix == m.cmatrix)),
+        WellResult.__table__.select().where(sa.and_(
+            WellResult.barcode == m.barcode, WellResult.drugset_id == m.drugset_id,
+            WellResult.cmatrix == m.cmatrix)),
+        DoseResponseCurve.__table__.select().where(sa.and_(
+            DoseResponseCurve.barcode == m.barcode, DoseResponseCurve.tag.in_(tags))),
+        SingleAgentWellResult.__table__.select().where(sa.and_(
+            SingleAgentWellResult.barcode == m.barcode,
+            SingleAgentWellResult.lib_drug.in_(tags),
+            SingleAgentWellResult.drugset_id == m.drugset_id)),
+    ]
+
+
+def combination_page_queries(c):
+    """The statements the combination page of combination `c` runs"""
+    return [
+        MatrixResult.__table__.select().where(sa.and_(
+            MatrixResult.project_id == c.project_id,
+            MatrixResult.lib1_id == c.lib1_id, MatrixResult.lib2_id == c.lib2_id)),
+        DoseResponseCurve.__table__.select().where(sa.and_(
+            DoseResponseCurve.project_id == c.project_id,
+            DoseResponseCurve.drug_id_lib.in_([c.lib1_id, c.lib2_id]))),
+    ]
+
+
+def benchmark_serving_mode(pages=50, rounds=3):
+    """
+    Time the queries of `pages` random matrix and combination pages on the
+    default connections and in each serving mode of db.py (see
+    DB_READ_ONLY and DB_IMMUTABLE), on fresh engines. The first round runs
+    on a cold page cache. The read only mode runs with the database in WAL
+    journaling, as it expects, and the journal mode is restored afterwards.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        raise RuntimeError("The serving modes only apply to SQLite")
+    journal_mode = db.engine.execute("PRAGMA journal_mode").scalar()
+    sample = sa.select([MatrixResult.__table__]).order_by(sa.func.random()).limit(pages)
+    matrices = db.engine.execute(sample).fetchall()
+    combinations = db.engine.execute(
+        sa.select([MatrixResult.project_id, MatrixResult.lib1_id,
+                   MatrixResult.lib2_id]).distinct()
+        .order_by(sa.func.random()).limit(pages)).fetchall()
+    page_queries = {
+        'matrix': [matrix_page_queries(m) for m in matrices],
+        'combination': [combination_page_queries(c) for c in combinations],
+    }
+
+    modes = {'default': {'read_only': False, 'immutable': False},
+             'read only': {'read_only': True, 'immutable': False},
+             'immutable': {'read_only': True, 'immutable': True}}
+    results = []
+    for mode, options in modes.items():
+        if options['read_only']:
+            db.engine.execute("PRAGMA journal_mode=WAL")
+        engine = db.create_engine(**options)
+        try:
+            for page, queries in page_queries.items():
+                for i in range(rounds):
+                    start = time.time()
+                    with engine.connect() as conn:
+                        for statements in queries:
+                            for statement in statements:
+                                conn.execute(statement).fetchall()
+                    seconds = time.time() - start
+                    results.append(dict(mode=mode, page=page, round=i + 1,
+                                        pages=len(queries), seconds=seconds,
+                                        pages_per_second=len(queries) / seconds))
+        finally:
+            engine.dispose()
+
+    db.engine.dispose()
+    db.engine.execute(f"PRAGMA journal_mode={journal_mode}")
+    return print_results(results)
+
+
+def benchmark_matrix_page(paths, rounds=3):
+    """
+    Render the layout of each matrix page in `paths` `rounds` times, each
+    in a new session as a request would, and report the SQL statements and
+    time of each render. Later rounds hit the per-process caches.
+    """
+    from pages import matrix
+
+    results = []
+    for path in paths:
+        for i in range(rounds):
+            with count_statements() as counter:
+                seconds, _ = timed(matrix.layout, path)
+            Session.remove()
+            results.append(dict(path=path, round=i + 1,
+                                statements=counter['statements'], seconds=seconds))
+
+    return print_results(results)
+
+
+def synthetic_project(n, n_drugs=100, n_models=1000):
+    """
+    The models, drugs, combinations and `n` matrix results of a synthetic
+    project with id 1, with random metrics
+    """
+    rng = np.random.RandomState(0)
+    drugs = synthetic_drugs(1000, n_drugs)
+    models = pd.DataFrame({'id': [f"SIDM{i:05d}" for i in range(n_models)],
+                           'cell_line_name': [f"Cell line {i}" for i in range(n_models)],
+                           'tissue': [f"Tissue {i % 20}" for i in range(n_models)],
+                           'cancer_type': [f"Cancer type {i % 40}" for i in range(n_models)]})
+
+    lib1_id = 1000 + rng.randint(0, n_drugs // 2, n)
+    lib2_id = 1000 + rng.randint(n_drugs // 2, n_drugs, n)
+    matrices = pd.DataFrame({
+        'barcode': np.arange(n) // 6, 'drugset_id': 1, 'cmatrix': np.arange(n) % 6 + 1,
+        'lib1_id': lib1_id, 'lib2_id': lib2_id,
+        'lib1_tag': 'L' + pd.Series(lib1_id).astype(str),
+        'lib2_tag': 'L' + pd.Series(lib2_id).astype(str),
+        'model_id': models.id.values[rng.randint(0, n_models, n)],
+        'project_id': 1,
+    })
+    matrices['replicate_group'] = MatrixResult.replicate_group_of(
+        matrices.lib1_id, matrices.lib2_id, matrices.model_id)
+    for column in MatrixResult.__table__.columns:
+        if column.name in matrices:
+            continue
+        if isinstance(column.type, sa.Float):
+            matrices[column.name] = rng.rand(n)
+        elif isinstance(column.type, sa.Integer):
+            matrices[column.name] = rng.randint(0, 49, n)
+        else:
+            matrices[column.name] = 'D1-D3'
+
+    combinations = matrices[['project_id', 'lib1_id', 'lib2_id']].drop_duplicates()
+    return models, drugs, combinations, matrices
+
+
+def analytics_queries():
+    """Statements like those of the project views, on the synthetic project"""
+    metric = MatrixResult.bliss_matrix
+    in_project = MatrixResult.project_id == 1
+    return {
+        # get_project_metrics
+        'metric scan': sa.select([metric]).where(in_project),
+        # cached_update_scatter, filtered on tissues
+        'filtered join': sa.select([
+            MatrixResult.project_id, metric, MatrixResult.combo_maxe,
+            MatrixResult.barcode, MatrixResult.cmatrix, MatrixResult.drugset_id,
+            Combination.lib1_id, Combination.lib2_id,
+            Model.cell_line_name.label('model_name'), Model.tissue, Model.cancer_type])
+        .select_from(MatrixResult.__table__.join(Combination.__table__).join(Model.__table__))
+        .where(in_project).where(Model.tissue.in_(['Tissue 1', 'Tissue 2'])),
+        # the per-combination summary of the boxplot
+        'group by combination': sa.select([
+            MatrixResult.lib1_id, MatrixResult.lib2_id, sa.func.count().label('matrices'),
+            sa.func.avg(metric).label('mean'), sa.func.min(metric).label('min'),
+            sa.func.max(metric).label('max')])
+        .where(in_project).group_by(MatrixResult.lib1_id, MatrixResult.lib2_id),
+        # get_metric_min_max
+        'well metric range': sa.select([sa.func.min(WellResult.inhibition),
+                                        sa.func.max(WellResult.inhibition)]),
+    }
+
+
+def benchmark_analytics(matrix_counts=(100000, 1000000), wells=1000000, rounds=3):
+    """
+    Compare the latency of the project views' scans and group-bys on
+    SQLite and on DuckDB over a Parquet export, for synthetic projects of
+    `matrix_counts` matrices with `wells` well results.
+    """
+    analytics.import_duckdb()
+    results = []
+    for n in matrix_counts:
+        with scratch_database() as engine, tempfile.TemporaryDirectory() as export:
+            start = time.time()
+            models, drugs, combinations, matrices = synthetic_project(n)
+            engine.execute(Project.__table__.insert(), [{'id': 1, 'name': 'Benchmark'}])
+            for model, df in ((Model, models), (Drug, drugs),
+                              (Combination, combinations), (MatrixResult, matrices)):
+                db_loader.insert_rows(model, df)
+            db_loader.insert_rows(WellResult, db_loader.encode_labels(
+                WellResult, synthetic_well_results(wells)))
+            engine.execute("ANALYZE")
+            print(f"Loaded {n} matrices and {wells} wells in {time.time() - start:.1f}s")
+
+            export_seconds, _ = timed(analytics.export_parquet, export, bind=engine)
+            print(f"Exported in {export_seconds:.1f}s")
+
+            for name, statement in analytics_queries().items():
+                sqlite_seconds = min(timed(pd.read_sql, statement, engine)[0]
+                                     for _ in range(rounds))
+                duckdb_seconds = min(timed(analytics.query_export, statement, export)[0]
+                                     for _ in range(rounds))
+                rows = len(analytics.query_export(statement, export))
+                assert rows == len(pd.read_sql(statement, engine)), name
+                results.append(dict(matrices=n, query=name, rows=rows,
+                                    sqlite_seconds=sqlite_seconds,
+                                    duckdb_seconds=duckdb_seconds,
+                                    speedup=sqlite_seconds / duckdb_seconds))
+
+    return print_results(results)
@@ -5,63 +5,574 @@
 !!! Run this program using gdscmatrixexplorer/cli.py !!!
 '''
 
+import csv
+import datetime
+import io
 import json
+import os
 import re
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from contextlib import contextmanager, ExitStack
 
+import numpy as np
 import pandas as pd
 import requests
+import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 from tqdm import tqdm
 
+import analytics
 from db import engine, Base
 from models import Model, Drug, Combination, MatrixResult, WellResult, \
-    DoseResponseCurve, SingleAgentWellResult, Project
+    MatrixWellArray, DoseResponseCurve, SingleAgentWellResult, Project, \
+    UploadCheckpoint, DataVersion, label_properties
+from scripts.input_files import read_input, read_input_chunks, memory_usage
+from scripts.profiling import UploadProfile, count_rows
 
 Session = sessionmaker(bind=engine)
 session = Session()
 
-Base.metadata.create_all(engine)
+CMP_API_URL = os.getenv('CMP_API_URL',
+                        'https://api.cellmodelpassports.sanger.ac.uk')
+SIDM_CACHE_PATH = os.getenv('SIDM_CACHE_PATH', 'data/sidm_cache.json')
+SIDM_WORKERS = 8
+
+_http = threading.local()
+
+BULK_LOAD_MODELS = [WellResult, SingleAgentWellResult, DoseResponseCurve]
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -512000,  # KiB, i.e. 500MB
+    'temp_store': 'MEMORY',
+}
+
+INSERT_BATCH_SIZE = 10000
+# Barcodes whose wells are read at once when packing matrix well arrays
+PACK_BATCH_BARCODES = 500
+# Positional placeholder of the DB-API paramstyles insert_rows supports
+PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+# Missing values in the CSV rows copy_rows sends to PostgreSQL
+COPY_NULL = r'\N'
+
+MATRIX_STATS_COLUMNS = ['CELL_LINE_NAME', 'TISSUE', 'CANCER_TYPE', 'MASTER_CELL_ID',
+                        'COSMIC_ID', 'DRUGSET_ID', 'cmatrix', 'BARCODE',
+                        'lib1', 'lib1_ID', 'lib1_name', 'lib1_target',
+                        'lib1_pathway', 'lib1_owner',
+                        'lib2', 'lib2_ID', 'lib2_name', 'lib2_target',
+                        'lib2_pathway', 'lib2_owner',
+                        'matrix_size', 'Delta_MaxE_lib1', 'Delta_MaxE_lib2',
+                        'growth_rate', 'doubling_time', 'Delta_combo_MaxE_day1']
+WELL_STATS_COLUMNS = ['DRUGSET_ID', 'cmatrix', 'BARCODE', 'POSITION', 'lib1',
+                      'lib1_dose', 'lib1_conc', 'lib2', 'lib2_dose', 'lib2_conc',
+                      'inhibition', 'HSA', 'HSA_excess', 'Bliss_additivity',
+                      'Bliss_excess']
+NLME_CURVE_COLUMNS = ['BARCODE', 'DRUGSET_ID', 'xmid', 'scal', 'RMSE', 'IC50',
+                      'auc', 'maxc', 'lib_drug']  # STILL NEED MINC
+NLME_WELL_COLUMNS = ['DRUGSET_ID', 'lib_drug', 'BARCODE', 'POSITION', 'y',
+                     'x_micromol']
+
+# Column types of the input files. Tags, doses and other labels repeated on
+# every row are categorical, and ids, matrix numbers and plate positions are
+# narrowed to the smallest integer type that holds them. Measurements stay
+# float64: they are stored as doubles and compared exactly in append mode.
+MATRIX_STATS_DTYPES = {
+    'CELL_LINE_NAME': 'category', 'TISSUE': 'category', 'CANCER_TYPE': 'category',
+    'DRUGSET_ID': 'int32', 'cmatrix': 'int16', 'BARCODE': 'int32',
+    'lib1': 'category', 'lib1_ID': 'int32', 'lib1_name': 'category',
+    'lib1_target': 'category', 'lib1_pathway': 'category', 'lib1_owner': 'category',
+    'lib2': 'category', 'lib2_ID': 'int32', 'lib2_name': 'category',
+    'lib2_target': 'category', 'lib2_pathway': 'category', 'lib2_owner': 'category',
+    'matrix_size': 'category',
+}
+WELL_STATS_DTYPES = {
+    'DRUGSET_ID': 'int32', 'cmatrix': 'int16', 'BARCODE': 'int32',
+    'POSITION': 'int16', 'lib1': 'category', 'lib1_dose': 'category',
+    'lib2': 'category', 'lib2_dose': 'category',
+}
+NLME_STATS_DTYPES = {
+    'BARCODE': 'int32', 'DRUGSET_ID': 'int32', 'lib_drug': 'category',
+    'POSITION': 'int16',
+}
+
+
+def is_matrix_stats_column(column):
+    """Whether any of the extract_* functions use `column` of the matrix stats"""
+    return column in MATRIX_STATS_COLUMNS or \
+        column.startswith(('HSA', 'Bliss', 'day1')) or \
+        column.endswith('MaxE')
 
 
 def upload_project(combo_matrix_stats_path: str,
                    combo_well_stats_path: str,
                    nlme_stats_path: str,
-                   project_name: str):
+                   project_name: str,
+                   chunksize: int = None,
+                   passports_url: str = CMP_API_URL,
+                   append: bool = False,
+                   bulk_load: bool = False,
+                   workers: int = 1,
+                   profile_path: str = None,
+                   references=None):
+    """
+    Upload a project from its combo matrix, combo well and NLME stats files,
+    each either CSV, Parquet or Arrow IPC (see scripts.input_files).
+
+    The upload runs the UPLOAD_STAGES in order and checkpoints each stage
+    once it has been committed. If an upload fails, running it again skips
+    the completed stages, without reading their inputs, and resumes at the
+    first incomplete stage in append mode, so that rows it had already
+    written are not inserted twice. The checkpoints are cleared once all
+    stages are done.
+
+    With ``chunksize`` set, the well and NLME stats files are never loaded
+    in full: they are read, filtered and inserted ``chunksize`` rows at a
+    time, so memory use does not grow with the size of the well files.
+
+    With ``append`` set, the project may already exist: incoming rows are
+    compared with the stored rows of the same barcodes and only new or
+    changed rows are written (see `write_delta`).
+
+    With ``bulk_load`` set, wells, single agent wells and curves are loaded
+    in `bulk_load_mode`.
+
+    With ``workers`` above 1, the input files are parsed, and the wells and
+    single agent wells extracted, concurrently on a pool of processes while
+    this process writes the stages to the database one by one.
+
+    With ``profile_path`` set, a JSON report of the time, rows and memory of
+    every stage is written there (see scripts.profiling), even if the
+    upload fails.
+
+    ``references`` is a `ReferenceCache` to share model, drug and SIDM
+    lookups with other uploads in the same process (see
+    scripts.batch_upload). Returns the `UploadProfile` of the upload.
+    """
+    Base.metadata.create_all(engine)
+    # Before the first write, so that the analytics export is not read while
+    # the tables change, and after the last, in case it was exported meanwhile
+    record_change()
+    upload = ProjectUpload(combo_matrix_stats_path, combo_well_stats_path,
+                           nlme_stats_path, get_project(project_name),
+                           chunksize=chunksize, passports_url=passports_url,
+                           append=append, references=references)
+
+    completed = completed_stages(upload.project)
+    if completed:
+        print(f"Resuming upload of {project_name}, "
+              f"completed: {', '.join(completed)}")
+    resuming = bool(completed)
+    profile = UploadProfile(project_name, chunksize=chunksize, append=append,
+                            bulk_load=bulk_load, workers=workers)
+
+    with ExitStack() as stack:
+        if profile_path:
+            stack.callback(profile.write, profile_path)
+
+        if workers > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            upload.prefetch(pool, [n for n, _ in UPLOAD_STAGES if n not in completed])
+
+        # bulk_load_mode is left, rebuilding the indexes, before any stage
+        # after the BULK_LOAD_STAGES
+        bulk_load_stack = stack.enter_context(ExitStack())
+        for name, stage in UPLOAD_STAGES:
+            if name in completed:
+                print(f"Skipping {name} (completed)")
+                profile.skip(name)
+                continue
+            if name not in BULK_LOAD_STAGES:
+                bulk_load_stack.close()
+            elif bulk_load:
+                bulk_load_stack.enter_context(bulk_load_mode())
+                bulk_load = False
+
+            # The first incomplete stage may have written part of its rows
+            upload.append = append or resuming
+            resuming = False
+
+            with profile.stage(name):
+                stage(upload)
+                record_stage(upload.project, name)
+
+        clear_stages(upload.project)
+        record_change()
+        profile.memory = upload.memory_summary()
+        print(f"Uploaded {project_name} in {time.time() - profile.start:.1f}s")
+        print_memory_summary(profile.memory)
+
+    analytics.warn_stale_export()
+    return profile
+
+
+def print_memory_summary(summary):
+    print("Input frame memory, compact vs inferred column types:")
+    for name, (used, inferred) in summary.items():
+        print(f"  {name}: {used / 1024 ** 2:.1f} MB vs {inferred / 1024 ** 2:.1f} MB "
+              f"({1 - used / max(inferred, 1):.0%} less)")
+
+
+class ProjectUpload:
+    """
+    Inputs and options of a project upload. The input files are only read
+    when a stage first needs them.
+    """
+
+    def __init__(self, combo_matrix_stats_path, combo_well_stats_path,
+                 nlme_stats_path, project, chunksize=None,
+                 passports_url=CMP_API_URL, append=False, references=None):
+        self.combo_matrix_stats_path = combo_matrix_stats_path
+        self.combo_well_stats_path = combo_well_stats_path
+        self.nlme_stats_path = nlme_stats_path
+        self.project = project
+        self.chunksize = chunksize
+        self.passports_url = passports_url
+        self.append = append
+        self.references = references or ReferenceCache()
+
+        self._combo_matrix_stats = None
+        self._well_results = None
+        self._nlme_results = None
+        self._curve_stats = None
+        self._valid_barcodes = None
+
+    def prefetch(self, pool, stages):
+        """
+        Start reading and extracting the inputs `stages` need on `pool`.
+        The properties below then wait for these results.
+        """
+        if set(stages) & {'models', 'drugs', 'combinations', 'matrix_results',
+                          'dose_response_curves'}:
+            self._combo_matrix_stats = pool.submit(read_matrix_stats,
+                                                   self.combo_matrix_stats_path)
+        if self.chunksize:
+            return
+        if 'well_results' in stages:
+            self._well_results = pool.submit(read_well_results,
+                                             self.combo_well_stats_path)
+        if set(stages) & {'single_agent_well_results', 'dose_response_curves'}:
+            self._nlme_results = pool.submit(read_single_agent_wells,
+                                             self.nlme_stats_path)
+
+    def fetch(self, attr, func, *args, **kwargs):
+        """The prefetched result in `attr`, or that of calling `func` now"""
+        value = getattr(self, attr)
+        if value is None:
+            value = func(*args, **kwargs)
+        elif isinstance(value, Future):
+            value = value.result()
+        setattr(self, attr, value)
+        return value
+
+    @property
+    def combo_matrix_stats(self):
+        return self.fetch('_combo_matrix_stats', read_matrix_stats,
+                          self.combo_matrix_stats_path)
+
+    @property
+    def well_results(self):
+        """All extracted well results of the combo well stats"""
+        return self.fetch('_well_results', read_well_results,
+                          self.combo_well_stats_path)
+
+    @property
+    def single_agent_wells(self):
+        """All extracted single agent wells of the NLME stats"""
+        return self.fetch('_nlme_results', read_single_agent_wells,
+                          self.nlme_stats_path)[0]
+
+    @property
+    def curve_stats(self):
+        """The curve columns of the NLME stats, without duplicates"""
+        if self._curve_stats is None:
+            if self.chunksize:
+                self._curve_stats = pd.concat(
+                    [chunk.drop_duplicates() for chunk in
+                     read_input_chunks(self.nlme_stats_path, self.chunksize,
+                                       usecols=NLME_CURVE_COLUMNS,
+                                       dtype=NLME_STATS_DTYPES)],
+                    ignore_index=True).drop_duplicates()
+            else:
+                self._curve_stats = self.fetch(
+                    '_nlme_results', read_single_agent_wells,
+                    self.nlme_stats_path)[1]
+        return self._curve_stats
+
+    @curve_stats.setter
+    def curve_stats(self, curve_stats):
+        self._curve_stats = curve_stats
+
+    def memory_summary(self):
+        """
+        Memory used by each input frame read whole, in bytes, with the
+        compact column types and as estimated for pandas' inferred types
+        """
+        frames = {'combo_matrix_stats': self._combo_matrix_stats,
+                  'well_results': self._well_results,
+                  'curve_stats': self._curve_stats}
+        if isinstance(self._nlme_results, tuple):
+            frames['single_agent_wells'] = self._nlme_results[0]
+        return {name: memory_usage(df) for name, df in frames.items()
+                if isinstance(df, pd.DataFrame)}
+
+    @property
+    def valid_barcodes(self):
+        """Barcodes of the project's matrices - other wells are not loaded"""
+        if self._valid_barcodes is None:
+            self._valid_barcodes = {
+                b for (b,) in session.query(MatrixResult.barcode.distinct())
+                .filter(MatrixResult.project_id == self.project.id)}
+        return self._valid_barcodes
+
+    @valid_barcodes.setter
+    def valid_barcodes(self, valid_barcodes):
+        self._valid_barcodes = valid_barcodes
+
+
+def load_models(upload):
+    add_new_models(upload.combo_matrix_stats, upload.passports_url,
+                   upload.references)
+
+
+def load_drugs(upload):
+    add_new_drugs(upload.combo_matrix_stats, upload.references)
+
+
+def load_combinations(upload):
+    drug_matrices = extract_drug_matrices(upload.combo_matrix_stats)
+    drug_matrices = add_project_id(drug_matrices, upload.project)
+    drug_matrices_to_db(drug_matrices, upload.append)
+
+
+def load_matrix_results(upload):
+    matrix_results = extract_matrix_results(upload.combo_matrix_stats, 'MASTER_CELL_ID')
+    models = upload.references.models(matrix_results.master_cell_id.unique().tolist())
+    matrix_results = add_model_id(matrix_results, models, 'master_cell_id')
+    matrix_results = add_project_id(matrix_results, upload.project)
+    matrix_results = add_replicate_group(matrix_results)
+    matrix_results_to_db(matrix_results, upload.append)
 
-    combo_matrix_stats = pd.read_csv(combo_matrix_stats_path)
-    combo_well_stats = pd.read_csv(combo_well_stats_path)
-    nlme_stats = pd.read_csv(nlme_stats_path)
+    upload.valid_barcodes = set(matrix_results.barcode)
 
-    project = get_project(project_name)
 
-    add_new_models(combo_matrix_stats)
-    models = pd.read_sql(session.query(Model).statement, session.bind)
+def load_well_results(upload):
+    if upload.chunksize:
+        stream_well_results(upload.combo_well_stats_path, upload.valid_barcodes,
+                            upload.chunksize, upload.append)
+        return
 
-    add_new_drugs(combo_matrix_stats)
+    well_results = upload.well_results
+    well_results = well_results[well_results.barcode.isin(upload.valid_barcodes)]
+    well_results_to_db(well_results, upload.append)
 
-    drug_matrices = extract_drug_matrices(combo_matrix_stats)
-    drug_matrices = add_project_id(drug_matrices, project)
-    drug_matrices_to_db(drug_matrices)
-    matrix_results = extract_matrix_results(combo_matrix_stats, 'MASTER_CELL_ID')
-    matrix_results = add_model_id(matrix_results, models, 'master_cell_id')
-    matrix_results = add_project_id(matrix_results, project)
-    matrix_results_to_db(matrix_results)
 
-    valid_barcodes = set(matrix_results.barcode)
+def load_matrix_well_arrays(upload):
+    pack_matrix_wells(upload.valid_barcodes)
+
+
+def load_single_agent_wells(upload):
+    if upload.chunksize:
+        upload.curve_stats = stream_single_agent_wells(
+            upload.nlme_stats_path, upload.valid_barcodes, upload.chunksize,
+            upload.append)
+        return
+
+    sa_wells = upload.single_agent_wells
+    sa_wells = sa_wells[sa_wells.barcode.isin(upload.valid_barcodes)]
+    sa_wells_to_db(sa_wells, upload.append)
+
+
+def load_dose_response_curves(upload):
+    dr_curves = extract_dose_response_curves(upload.combo_matrix_stats,
+                                             upload.curve_stats)
+    dr_curves = dr_curves[dr_curves.barcode.isin(upload.valid_barcodes)]
+    dr_curves = add_project_id(dr_curves, upload.project)
+    dr_curves_to_db(dr_curves, upload.append)
+
+
+def read_matrix_stats(combo_matrix_stats_path):
+    return read_input(combo_matrix_stats_path, usecols=is_matrix_stats_column,
+                      dtype=MATRIX_STATS_DTYPES)
+
+
+def read_well_results(combo_well_stats_path):
+    combo_well_stats = read_input(combo_well_stats_path,
+                                  usecols=WELL_STATS_COLUMNS,
+                                  dtype=WELL_STATS_DTYPES)
+    return extract_well_results(combo_well_stats)
+
+
+def read_single_agent_wells(nlme_stats_path):
+    """The single agent wells and the distinct curve parameters of the NLME stats"""
+    nlme_stats = read_input(nlme_stats_path,
+                            usecols=NLME_CURVE_COLUMNS + NLME_WELL_COLUMNS,
+                            dtype=NLME_STATS_DTYPES)
+    return extract_single_agent_wells(nlme_stats), \
+        nlme_stats[NLME_CURVE_COLUMNS].drop_duplicates()
+
+
+# Single agent wells go before the curves, so that a chunked upload can
+# collect the curve parameters while streaming the NLME stats once. The
+# matrix well arrays go last, after the BULK_LOAD_STAGES, as packing reads
+# the well results by barcode through their index.
+UPLOAD_STAGES = [
+    ('models', load_models),
+    ('drugs', load_drugs),
+    ('combinations', load_combinations),
+    ('matrix_results', load_matrix_results),
+    ('well_results', load_well_results),
+    ('single_agent_well_results', load_single_agent_wells),
+    ('dose_response_curves', load_dose_response_curves),
+    ('matrix_well_arrays', load_matrix_well_arrays),
+]
+BULK_LOAD_STAGES = ['well_results', 'single_agent_well_results',
+                    'dose_response_curves']
+
 
-    well_results = extract_well_results(combo_well_stats)
-    well_results = well_results[well_results.barcode.isin(valid_barcodes)]
-    well_results_to_db(well_results)
+def completed_stages(project):
+    completed = {c.stage for c in
+                 session.query(UploadCheckpoint).filter_by(project_id=project.id)}
+    return [name for name, _ in UPLOAD_STAGES if name in completed]
 
-    dr_curves = extract_dose_response_curves(combo_matrix_stats, nlme_stats)
-    dr_curves = dr_curves[dr_curves.barcode.isin(valid_barcodes)]
-    dr_curves = add_project_id(dr_curves, project)
-    dr_curves_to_db(dr_curves)
 
-    sa_wells = extract_single_agent_wells(nlme_stats)
-    sa_wells = sa_wells[sa_wells.barcode.isin(valid_barcodes)]
-    sa_wells_to_db(sa_wells)
+def record_stage(project, stage):
+    session.merge(UploadCheckpoint(project_id=project.id, stage=stage,
+                                   completed_at=datetime.datetime.now()))
+    session.commit()
+
+
+def clear_stages(project):
+    session.query(UploadCheckpoint).filter_by(project_id=project.id)\
+        .delete(synchronize_session=False)
+    session.commit()
+
+
+def record_change():
+    """Increase the DataVersion, which makes the analytics export out of date"""
+    DataVersion.increment(session)
+    session.commit()
+
+
+@contextmanager
+def bulk_load_mode(models=BULK_LOAD_MODELS):
+    """
+    Load `models`' tables without live secondary indexes and, on SQLite,
+    with journaling and syncing relaxed (BULK_LOAD_PRAGMAS).
+
+    The indexes are rebuilt, the previous settings restored and the
+    tables ANALYZEd afterwards, also when the load fails. A crash of the
+    machine while in this mode can corrupt the database file.
+    """
+    sqlite = engine.dialect.name == 'sqlite'
+    if sqlite:
+        journal_mode = engine.execute("PRAGMA journal_mode").scalar()
+        sa.event.listen(engine, 'connect', set_bulk_load_pragmas)
+    reset_connections()
+
+    dropped = drop_indexes(models)
+    try:
+        yield
+    finally:
+        if sqlite:
+            sa.event.remove(engine, 'connect', set_bulk_load_pragmas)
+        reset_connections()
+        if sqlite:
+            # The only setting that outlives a connection
+            engine.execute(f"PRAGMA journal_mode={journal_mode}")
+
+        for index in dropped:
+            print(f"Rebuilding index {index.name}")
+            index.create(bind=engine)
+        for model in models:
+            engine.execute(f"ANALYZE {model.__tablename__}")
+
+
+def set_bulk_load_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in BULK_LOAD_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def reset_connections():
+    """Make sure later statements run on new connections"""
+    session.rollback()
+    engine.dispose()
+
+
+def drop_indexes(models):
+    """Drop the declared indexes of `models` that exist in the database"""
+    inspector = sa.inspect(engine)
+    dropped = []
+    for model in models:
+        table = model.__table__
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(bind=engine)
+                dropped.append(index)
+    return dropped
+
+
+def stream_to_db(model, chunks, extract, valid_barcodes, append=False):
+    """
+    Extract, filter and insert `chunks` one at a time so that only a single
+    chunk is held in memory. Reports throughput per chunk.
+
+    Duplicate rows are dropped per chunk, as insert_rows does, so memory
+    stays flat whatever the file size. Rows repeated across chunks are only
+    skipped in append mode, which leaves out the rows already stored.
+    """
+    print(f"Streaming {model.__tablename__}")
+    total_rows = 0
+    for i, chunk in enumerate(chunks, start=1):
+        start = time.time()
+        rows = extract(chunk)
+        rows = rows[rows.barcode.isin(valid_barcodes)].drop_duplicates()
+        to_db(model, rows, append=append, verbose=False)
+        elapsed = max(time.time() - start, 1e-6)
+        total_rows += len(rows)
+        print(f"  chunk {i}: {len(rows)} rows in {elapsed:.2f}s "
+              f"({len(rows) / elapsed:.0f} rows/s)")
+
+    print(f"Uploaded {total_rows} rows to {model.__tablename__}")
+    return total_rows
+
+
+def stream_well_results(combo_well_stats_path, valid_barcodes, chunksize,
+                        append=False):
+    chunks = read_input_chunks(combo_well_stats_path, chunksize,
+                               usecols=WELL_STATS_COLUMNS,
+                               dtype=WELL_STATS_DTYPES)
+    return stream_to_db(WellResult, chunks, extract_well_results, valid_barcodes,
+                        append)
+
+
+def stream_single_agent_wells(nlme_stats_path, valid_barcodes, chunksize,
+                              append=False):
+    """
+    Stream the single agent wells in `nlme_stats_path` to the database.
+
+    The curve parameters are repeated on every well of the NLME stats, so
+    they are de-duplicated per chunk on the way through and returned for
+    `extract_dose_response_curves`.
+    """
+    curve_stats = []
+
+    def extract(chunk):
+        curves = chunk[chunk.BARCODE.isin(valid_barcodes)][NLME_CURVE_COLUMNS]
+        curve_stats.append(curves.drop_duplicates())
+        return extract_single_agent_wells(chunk)
+
+    chunks = read_input_chunks(nlme_stats_path, chunksize,
+                               usecols=NLME_CURVE_COLUMNS + NLME_WELL_COLUMNS,
+                               dtype=NLME_STATS_DTYPES)
+    stream_to_db(SingleAgentWellResult, chunks, extract, valid_barcodes, append)
+
+    return pd.concat(curve_stats, ignore_index=True).drop_duplicates()
 
 
 def get_project(project_name):
@@ -74,13 +585,48 @@ def get_project(project_name):
     return db_p
 
 
-def add_new_models(combo_matrix_stats):
+class ReferenceCache:
+    """
+    Reference data looked up by uploads, kept so that uploads sharing a
+    ReferenceCache look each of them up once: the `hash_rows` hashes of
+    model and drug rows known to be stored, the stored model ids by master
+    cell id, and the SIDM cache.
+    """
+
+    def __init__(self, sidm_cache_path=SIDM_CACHE_PATH):
+        self.stored = {Model: set(), Drug: set()}
+        self.model_ids = {}
+        self.sidms = load_sidm_cache(sidm_cache_path)
+
+    def add(self, model, df):
+        """Record the rows of `df` as stored in `model`'s table"""
+        self.stored[model].update(hash_rows(model, df))
+
+    def models(self, master_cell_ids):
+        """The stored id of every model in `master_cell_ids` that has one"""
+        missing = [i for i in master_cell_ids if i not in self.model_ids]
+        if missing:
+            stored = stored_rows(Model, 'master_cell_id', missing,
+                                 ['id', 'master_cell_id'])
+            self.model_ids.update(zip(stored.master_cell_id, stored.id))
+        return pd.DataFrame(
+            [(self.model_ids[i], i) for i in master_cell_ids if i in self.model_ids],
+            columns=['id', 'master_cell_id'])
+
+
+def add_new_models(combo_matrix_stats, passports_url=CMP_API_URL,
+                   references=None):
+    references = references or ReferenceCache()
     models = extract_models(combo_matrix_stats)
-    new_models = get_new(Model, models)
-    new_models = add_sidms(new_models, 'MASTER_CELL_ID', 'master_cell_id', verbose=True)
+    new_models = get_new(Model, models, key='master_cell_id',
+                         known=references.stored[Model])
+    new_models = add_sidms(new_models, 'MASTER_CELL_ID', 'master_cell_id',
+                           verbose=True, base_url=passports_url,
+                           cache=references.sidms)
     new_models = new_models[pd.notna(new_models.id)]
     if not new_models.empty:
         models_to_db(new_models)
+        references.add(Model, new_models[models.columns])
 
 def extract_models(combo_matrix_stats):
     models = combo_matrix_stats[["CELL_LINE_NAME"]].copy()
@@ -98,69 +644,168 @@ def extract_models(combo_matrix_stats):
     return models.drop_duplicates()
 
 
-def get_new(model, df):
-    db_models = pd.read_sql(session.query(model).statement, session.bind)
-    if not db_models.empty:
-        db_models = db_models[df.columns].copy()
+def get_new(model, df, key=None, known=None):
+    """
+    Rows of `df` that are not yet in `model`'s table with identical values.
 
-    # Make sure the column types match
-    for col in db_models.columns:
-        if col in df.columns:
-            if db_models[col].dtype == 'object':
-                df[col] = df[col].astype(str)
-            else:
-                df[col] = df[col].astype(db_models[col].dtype)
+    Only the stored rows sharing a `key` value (by default the primary key)
+    with `df` are read, and rows are matched on a hash of all of `df`'s
+    columns, so the cost follows the size of `df` rather than the table.
 
-    # new as in 'not yet in database'
-    new = pd.concat([db_models, db_models, df], ignore_index=True, sort=False)\
-        .drop_duplicates(keep=False)[df.columns]
+    `known` is an optional set of `hash_rows` hashes of rows known to be
+    stored: such rows are skipped without a query, and the hashes of the
+    rows found stored are added to it.
+    """
+    if key is None:
+        key = next(c.key for c in model.__table__.primary_key if c.key in df.columns)
 
+    # new as in 'not yet in database'
+    new = df.drop_duplicates()
+    hashes = hash_rows(model, new)
+    if known:
+        is_known = hashes.isin(known).values
+        new, hashes = new[~is_known], hashes[~is_known]
+
+    stored = stored_rows(model, key, new[key].drop_duplicates().tolist(), df.columns)
+    if not stored.empty:
+        is_stored = hashes.isin(hash_rows(model, stored)).values
+        if known is not None:
+            known.update(hashes[is_stored])
+        new = new[~is_stored]
+
+    count_rows(len(df), 0)
     return new
 
 
-def add_sidms(models: pd.DataFrame, identifier_type: str, identifier_column: str, verbose: bool=False) -> pd.DataFrame:
+def hash_rows(model, df):
+    """
+    Hash every row of `df`, with values first brought to a form that depends
+    only on the type of the matching column in `model`'s table, so that e.g.
+    900, 900.0 and '900' or NaN and None hash the same.
+    """
+    columns = {}
+    for c in df.columns:
+        if isinstance(model.__table__.c[c].type, (sa.Integer, sa.Float)):
+            columns[c] = pd.to_numeric(df[c], errors='coerce').astype(float)
+        else:
+            columns[c] = df[c].astype(object).where(df[c].notnull(), None).astype(str)
+
+    return pd.util.hash_pandas_object(pd.DataFrame(columns), index=False)
+
+
+def add_sidms(models: pd.DataFrame, identifier_type: str, identifier_column: str,
+              verbose: bool=False, base_url: str=CMP_API_URL,
+              workers: int=SIDM_WORKERS,
+              cache_path: str=SIDM_CACHE_PATH,
+              cache: dict=None) -> pd.DataFrame:
+    """
+    Add the Sanger model id (SIDM) of every model as an 'id'-column.
+
+    Identifiers already in the on-disk cache at `cache_path` are never
+    looked up again; the others are resolved against the Cell Model
+    Passports API at `base_url` by `workers` concurrent requests.
+    A `cache` already loaded from `cache_path` is used, and updated,
+    instead of reading the file again.
+    """
     if verbose:
         print("Adding Sanger IDs from Passports...")
     models = models.copy()
-    sidms = []
-    pbar = tqdm(total=len(models))
-    for m in models.itertuples():
-        pbar.set_description(f"Processing {getattr(m, identifier_column):>10}")
-        pbar.update(1)
-        sidms.append(get_sidm(getattr(m, identifier_column), identifier_type))
+    if cache is None:
+        cache = load_sidm_cache(cache_path)
+    identifiers = [normalise_identifier(i) for i in models[identifier_column]]
 
-    del pbar
-    models['id'] = sidms
+    known = {i for i in identifiers if i is not None}
+    unresolved = {i for i in known
+                  if sidm_cache_key(identifier_type, i) not in cache}
+    if verbose:
+        print(f"{len(known) - len(unresolved)} cached, "
+              f"{len(unresolved)} to resolve")
+
+    if unresolved:
+        # identifiers resolved before a lookup failed are not looked up again
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(get_sidm, i, identifier_type,
+                                       base_url=base_url): i
+                           for i in unresolved}
+                for future in tqdm(as_completed(futures), total=len(futures),
+                                   disable=not verbose):
+                    sidm = future.result()
+                    if sidm is not None:
+                        cache[sidm_cache_key(identifier_type, futures[future])] = sidm
+        finally:
+            save_sidm_cache(cache, cache_path)
+
+    models['id'] = [cache.get(sidm_cache_key(identifier_type, i)) for i in identifiers]
 
     return models
 
 
-def get_sidm(identifier: int, identifier_type:str, retries: int = 3):
+def normalise_identifier(identifier):
+    """Model identifiers may arrive as int, float or str - use a single form"""
+    if identifier is None or pd.isnull(identifier):
+        return None
+    try:
+        return int(float(identifier))
+    except ValueError:
+        return identifier
+
+
+def sidm_cache_key(identifier_type, identifier):
+    return f"{identifier_type}:{identifier}"
+
+
+def load_sidm_cache(cache_path):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+
+def save_sidm_cache(cache, cache_path):
+    if cache_path is None:
+        return
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def http_session():
+    """requests.Session per thread, so resolver threads reuse connections"""
+    if not hasattr(_http, 'session'):
+        _http.session = requests.Session()
+    return _http.session
+
+
+def get_sidm(identifier: int, identifier_type:str, retries: int = 3,
+             base_url: str = CMP_API_URL):
+    """
+    The SIDM of `identifier`, or None if the API does not know it. Failed
+    requests are tried `retries` times in all, and the error of the last
+    attempt is raised.
+    """
     if identifier is None:
         return None
 
-    attempt = 1
-    while attempt < retries:
-        resp = requests.get(
-            f"https://api.cellmodelpassports.sanger.ac.uk/models/{identifier_type}/"
-            f"{identifier}?fields[model]=id")
-        attempt += 1
-
-        if resp.status_code == 200:
-            try:
-                return resp.json()['data']['id']
-            except json.decoder.JSONDecodeError as e:
-                print(f"Error parsing {identifier}'s response")
-                continue
-        elif resp.status_code == 404:
-            print(f"{identifier} not found")
-            return None
-        else:
+    for attempt in range(1, retries + 1):
+        if attempt > 1:
             time.sleep(1)
-            continue
-
-    print(f"Max retries exceeded for {identifier}")
-    return None
+        try:
+            resp = http_session().get(
+                f"{base_url}/models/{identifier_type}/"
+                f"{identifier}?fields[model]=id", timeout=10)
+            if resp.status_code == 404:
+                print(f"{identifier} not found")
+                return None
+            resp.raise_for_status()
+            return resp.json()['data']['id']
+        except (requests.exceptions.RequestException, ValueError):
+            # JSONDecodeError is a ValueError
+            if attempt == retries:
+                print(f"Max retries exceeded for {identifier}")
+                raise
 
 
 def models_to_db(models):
@@ -169,21 +814,46 @@ def models_to_db(models):
 
 
 def upsert(model, df):
+    """
+    Insert or update the rows of `df` in `model`'s table, matching on id.
+
+    Existing ids are looked up in batches, then all new rows are written
+    with a single executemany INSERT and all known rows with a single
+    executemany UPDATE, instead of one ORM round trip per row.
+    """
     assert 'id' in df.columns, "Upsert requires an 'id'-column in df"
     print(f"Updating {model.__tablename__}")
-    for row in df.itertuples():
-        in_db = session.query(model).get(row.id)
-        if not in_db:
-            in_db = model()
-            in_db.id = row.id
-            session.add(in_db)
-        for column in model.__table__.columns:
-            try:
-                setattr(in_db, column.key, getattr(row, column.key))
-            except AttributeError:
-                continue
+    table = model.__table__
+    columns = [c.key for c in table.columns if c.key in df.columns]
+    records = df[columns].drop_duplicates(subset=['id'], keep='last')\
+        .to_dict('records')
+
+    in_db = existing_ids(model, [r['id'] for r in records])
+    inserts = [r for r in records if str(r['id']) not in in_db]
+    updates = [dict({k: v for k, v in r.items() if k != 'id'}, _id=r['id'])
+               for r in records if str(r['id']) in in_db]
+
+    if inserts:
+        session.execute(table.insert(), inserts)
+    if updates and len(columns) > 1:
+        session.execute(
+            table.update().where(table.c.id == sa.bindparam('_id')), updates)
     session.commit()
 
+    count_rows(0, len(inserts) + len(updates))
+    print(f"{len(inserts)} inserted, {len(updates)} updated")
+    return len(inserts), len(updates)
+
+
+def existing_ids(model, ids, batch_size=500):
+    """Ids (as strings) of `ids` already in `model`'s table"""
+    in_db = set()
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        in_db.update(str(r[0]) for r in
+                     session.query(model.id).filter(model.id.in_(batch)))
+    return in_db
+
 
 def upsert_new(model, df):
     assert 'id' in df.columns, "Upsert requires an 'id'-column in df"
@@ -193,10 +863,12 @@ def upsert_new(model, df):
         session.merge(in_db)
 
 
-def add_new_drugs(combo_matrix_stats):
+def add_new_drugs(combo_matrix_stats, references=None):
+    references = references or ReferenceCache()
     drugs = extract_drugs(combo_matrix_stats)
-    new_drugs = get_new(Drug, drugs)
+    new_drugs = get_new(Drug, drugs, known=references.stored[Drug])
     upsert(Drug, new_drugs)
+    references.add(Drug, new_drugs)
 
 
 def extract_drugs(combo_matrix_stats):
@@ -219,22 +891,220 @@ def extract_drug_matrices(combo_matrix_stats):
     return drug_matrix.drop_duplicates()
 
 
-def drug_matrices_to_db(drug_matrices):
-    to_db(Combination, drug_matrices)
+def drug_matrices_to_db(drug_matrices, append=False):
+    to_db(Combination, drug_matrices, append)
 
 
-def to_db(model, df, append=False):
-    print(f"Uploading {model.__tablename__}")
+def to_db(model, df, append=False, verbose=True):
+    if verbose:
+        print(f"Uploading {model.__tablename__}")
 
     df.columns = [c.lower() for c in df.columns]
+    df = encode_labels(model, df)
+
+    if append:
+        return write_delta(model, df, verbose)
+    rows = insert_rows(model, df)
+    count_rows(len(df), rows)
+
+
+def encode_labels(model, df):
+    """
+    Replace the tag and dose columns of `df` by the ids the well tables
+    store them as (see models.label_property), adding the labels not yet
+    stored. Ids never change, so encoded rows compare to stored rows.
+    """
+    labels = [(name, id_column, lookup) for name, id_column, lookup
+              in label_properties(model) if name in df.columns]
+    if not labels:
+        return df
+
+    ids = {}
+    for name, id_column, lookup in labels:
+        values = df[name].astype(object)
+        # int64, or float64 where labels are missing
+        ids[id_column] = pd.to_numeric(
+            values.map(label_ids(lookup, values.dropna().unique().tolist())))
+    return df.drop(columns=[name for name, _, _ in labels]).assign(**ids)
+
+
+def label_ids(lookup, labels):
+    """The ids of `labels` in `lookup`'s table, adding those it lacks"""
+    stored = stored_rows(lookup, 'label', labels, ['label', 'id'])
+    new = sorted(set(labels) - set(stored.label))
+    if new:
+        session.execute(lookup.__table__.insert(), [{'label': l} for l in new])
+        session.commit()
+        stored = stored_rows(lookup, 'label', labels, ['label', 'id'])
+    return dict(zip(stored.label, stored.id))
+
+
+def insert_rows(model, df, batch_size=INSERT_BATCH_SIZE):
+    """
+    Insert the distinct rows of `df`, returning how many were inserted.
+
+    Rows are sent as tuples, `batch_size` at a time, through the driver's
+    executemany on a single connection and transaction, so that only one
+    batch of Python values exists at a time. On PostgreSQL each batch is
+    streamed through COPY instead.
+    """
+    if df.empty:
+        return 0
+    table = model.__table__
+    # Columns the table does not have are ignored, as by table.insert()
+    df = df.drop_duplicates()
+    df = df[[c for c in df.columns if c in table.c]]
+    sql = insert_statement(table, df.columns)
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        for start in range(0, len(df), batch_size):
+            batch = df.iloc[start:start + batch_size]
+            if engine.dialect.name == 'postgresql':
+                copy_rows(cursor, table, batch)
+            else:
+                cursor.executemany(sql, row_tuples(batch))
+        cursor.close()
+    session.commit()
+    return len(df)
+
+
+def insert_statement(table, columns):
+    """A plain INSERT of `columns` into `table` in the driver's paramstyle"""
+    preparer = engine.dialect.identifier_preparer
+    placeholder = PLACEHOLDERS[engine.dialect.paramstyle]
+    return f"INSERT INTO {preparer.format_table(table)} " \
+           f"({', '.join(preparer.quote(table.c[c].name) for c in columns)}) " \
+           f"VALUES ({', '.join([placeholder] * len(columns))})"
+
+
+def copy_rows(cursor, table, df):
+    """Send the rows of `df` to `table` through PostgreSQL's COPY, as CSV"""
+    preparer = engine.dialect.identifier_preparer
+    integer_columns = [c for c in df.columns if isinstance(table.c[c].type, sa.Integer)]
+    columns = ', '.join(preparer.quote(table.c[c].name) for c in df.columns)
+    buffer = io.StringIO()
+    # Strings are quoted, so that an empty string stays one. The csv module
+    # quotes None as well, so missing values are written as the NULL marker
+    # instead, which FORCE_NULL reads as NULL even when quoted.
+    csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)\
+        .writerows(row_tuples(df, integer_columns, null=COPY_NULL))
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {preparer.format_table(table)} ({columns}) FROM STDIN WITH "
+        f"(FORMAT csv, NULL '{COPY_NULL}', FORCE_NULL ({columns}))", buffer)
+
+
+def row_tuples(df, integer_columns=(), null=None):
+    """
+    The rows of `df` as tuples of Python values, with `null` for NaN.
+    Float values of `integer_columns` (integers with missing values) are
+    converted back to ints, which COPY requires.
+    """
+    columns = []
+    for c in df.columns:
+        values = df[c].astype(object).where(df[c].notnull(), null).tolist()
+        if c in integer_columns and df[c].dtype.kind == 'f':
+            values = [int(v) if isinstance(v, float) else v for v in values]
+        columns.append(values)
+    return list(zip(*columns))
+
+
+# Natural keys used to match incoming rows to stored rows in append mode.
+# The first key is used to fetch the stored rows.
+APPEND_KEYS = {
+    Combination: ['project_id', 'lib1_id', 'lib2_id'],
+    MatrixResult: ['barcode', 'drugset_id', 'cmatrix'],
+    WellResult: ['barcode', 'drugset_id', 'cmatrix', 'position'],
+    DoseResponseCurve: ['barcode', 'drugset_id', 'tag'],
+    SingleAgentWellResult: ['barcode', 'drugset_id', 'lib_drug_id', 'position'],
+}
+
+
+def write_delta(model, df, verbose=True):
+    """
+    Write the rows of `df` that are not yet stored, or are stored with
+    different values, matching rows on `model`'s APPEND_KEYS.
+
+    Only stored rows sharing a key value (barcode, or project for
+    combinations) with `df` are read, so the cost follows the incoming
+    batch rather than the size of the table. Changed rows are deleted
+    and re-inserted.
+    """
+    keys = APPEND_KEYS[model]
+    table_columns = [c.key for c in model.__table__.columns]
+    df = df[[c for c in df.columns if c in table_columns]]\
+        .drop_duplicates()\
+        .reset_index(drop=True)
+
+    stored = stored_rows(model, keys[0], df[keys[0]].drop_duplicates().tolist(),
+                         df.columns)
+    new, changed = split_delta(df, stored, keys)
+
+    if not changed.empty:
+        delete_rows(model, changed, keys)
+    insert_rows(model, pd.concat([new, changed]))
+    count_rows(len(df), len(new) + len(changed))
 
-    df = get_new(model, df) if append else df
-    engine.execute(
-        model.__table__.insert(),
-        df.drop_duplicates().to_dict('records')
+    if verbose:
+        print(f"{len(new)} new, {len(changed)} changed, "
+              f"{len(df) - len(new) - len(changed)} unchanged")
+    return len(new), len(changed)
+
+
+def stored_rows(model, column, values, columns, batch_size=500):
+    """`columns` of the rows in `model`'s table whose `column` is in `values`"""
+    table = model.__table__
+    select = sa.select([table.c[c] for c in columns])
+    frames = [
+        pd.read_sql(select.where(table.c[column].in_(values[i:i + batch_size])),
+                    session.bind)
+        for i in range(0, len(values), batch_size)
+    ]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def split_delta(df, stored, keys):
+    """Split `df` into rows missing from `stored` and rows that differ from it"""
+    if stored.empty:
+        return df, df.iloc[:0]
+
+    merged = df.merge(stored.drop_duplicates(subset=keys), on=keys, how='left',
+                      suffixes=('', '_stored'), indicator=True)
+    is_new = (merged['_merge'] == 'left_only').values
+
+    is_changed = pd.Series(False, index=merged.index)
+    for column in df.columns:
+        if column not in keys:
+            is_changed |= ~values_equal(merged[column], merged[column + '_stored'])
+    is_changed = is_changed.values & ~is_new
+
+    return df[is_new], df[is_changed]
+
+
+def values_equal(incoming, stored):
+    if pd.api.types.is_numeric_dtype(incoming):
+        incoming = incoming.astype(float)
+        stored = pd.to_numeric(stored, errors='coerce')
+        both_null = incoming.isnull() & stored.isnull()
+        return pd.Series(np.isclose(incoming, stored, rtol=1e-9, atol=0),
+                         index=incoming.index) | both_null
+
+    both_null = incoming.isnull() & stored.isnull()
+    return (incoming.astype(str) == stored.astype(str)) | both_null
+
+
+def delete_rows(model, df, keys):
+    """Delete the rows of `model`'s table matching the `keys` of the rows in `df`"""
+    table = model.__table__
+    session.execute(
+        table.delete().where(
+            sa.and_(*[table.c[k] == sa.bindparam(f"_{k}") for k in keys])),
+        [{f"_{k}": v for k, v in r.items()} for r in df[keys].to_dict('records')]
     )
     session.commit()
-    return
+
 
 def extract_matrix_results(combo_matrix_stats, id_mapper):
     hsa_cols = [c for c in combo_matrix_stats.columns if c.startswith("HSA")]
@@ -271,16 +1141,19 @@ def add_project_id(df, project):
     return df
 
 
-def matrix_results_to_db(matrix_results):
-    to_db(MatrixResult, matrix_results)
+def add_replicate_group(matrix_results):
+    matrix_results['replicate_group'] = MatrixResult.replicate_group_of(
+        matrix_results.lib1_id, matrix_results.lib2_id, matrix_results.model_id)
+    return matrix_results
+
+
+def matrix_results_to_db(matrix_results, append=False):
+    to_db(MatrixResult, matrix_results, append)
 
 
 def extract_well_results(combo_well_stats):
 
-    columns = ['DRUGSET_ID', 'cmatrix', 'BARCODE', 'POSITION', 'lib1', 'lib1_dose',
-               'lib1_conc', 'lib2', 'lib2_dose', 'lib2_conc', 'inhibition', 'HSA',
-               'HSA_excess', 'Bliss_additivity', 'Bliss_excess']
-    well_results = combo_well_stats[columns]\
+    well_results = combo_well_stats[WELL_STATS_COLUMNS]\
         .rename(columns={
             "lib1": "lib1_tag",
             "lib2": "lib2_tag",
@@ -289,8 +1162,50 @@ def extract_well_results(combo_well_stats):
     return well_results
 
 
-def well_results_to_db(well_results):
-    to_db(WellResult, well_results)
+def well_results_to_db(well_results, append=False):
+    to_db(WellResult, well_results, append)
+
+
+def pack_matrix_wells(barcodes, batch_size=PACK_BATCH_BARCODES):
+    """
+    Pack the stored well results of every matrix of `barcodes` into its
+    MatrixWellArray, replacing any packed before, `batch_size` barcodes at
+    a time. Packing from the database rather than the input files works
+    the same for chunked, appended and resumed uploads and for backfills.
+    """
+    barcodes = sorted(int(b) for b in barcodes)
+    columns = [WellResult.barcode, WellResult.drugset_id, WellResult.cmatrix,
+               WellResult.lib1_conc, WellResult.lib2_conc] + \
+        [getattr(WellResult, m) for m in MatrixWellArray.METRICS]
+    table = MatrixWellArray.__table__
+
+    packed = unpacked = 0
+    for start in range(0, len(barcodes), batch_size):
+        batch = barcodes[start:start + batch_size]
+        wells = pd.read_sql(sa.select(columns).where(WellResult.barcode.in_(batch)),
+                            engine)
+        arrays = []
+        for (barcode, drugset_id, cmatrix), matrix_wells in \
+                wells.groupby(['barcode', 'drugset_id', 'cmatrix']):
+            data = MatrixWellArray.pack(matrix_wells)
+            if data is None:
+                unpacked += 1
+                continue
+            arrays.append(dict(barcode=int(barcode), drugset_id=int(drugset_id),
+                               cmatrix=int(cmatrix), data=data))
+
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.barcode.in_(batch)))
+            if arrays:
+                conn.execute(table.insert(), arrays)
+        count_rows(len(wells), len(arrays))
+        packed += len(arrays)
+
+    print(f"Packed the wells of {packed} matrices")
+    if unpacked:
+        print(f"{unpacked} matrices with wells sharing concentrations were not "
+              f"packed, their pages read the well results")
+    return packed
 
 
 def extract_dose_response_curves(matrix_stats, nlme_stats):
@@ -304,9 +1219,7 @@ def extract_dose_response_curves(matrix_stats, nlme_stats):
 
     drug_details = lib1_details.append(lib2_details, sort=False).drop_duplicates()
 
-    dr_curves = nlme_stats[
-        ['BARCODE', 'DRUGSET_ID', 'xmid', 'scal', 'RMSE', 'IC50', 'auc', 'maxc', 'lib_drug'] # STILL NEED MINC
-    ]\
+    dr_curves = nlme_stats[NLME_CURVE_COLUMNS]\
         .drop_duplicates()\
         .rename(columns={'lib_drug': 'tag'})\
         .merge(drug_details, on=['BARCODE', 'DRUGSET_ID', 'tag'])
@@ -318,12 +1231,12 @@ def extract_dose_response_curves(matrix_stats, nlme_stats):
     return dr_curves
 
 
-def dr_curves_to_db(dr_curves):
-    to_db(DoseResponseCurve, dr_curves)
+def dr_curves_to_db(dr_curves, append=False):
+    to_db(DoseResponseCurve, dr_curves, append)
 
 
 def extract_single_agent_wells(nlme_stats):
-    wells = nlme_stats[['DRUGSET_ID', 'lib_drug', 'BARCODE', 'POSITION', 'y', 'x_micromol']]\
+    wells = nlme_stats[NLME_WELL_COLUMNS]\
         .rename(columns={"y": "inhibition", "x_micromol": "conc"})\
         .drop_duplicates()
 
@@ -333,8 +1246,8 @@ def extract_single_agent_wells(nlme_stats):
     return wells
 
 
-def sa_wells_to_db(wells):
-    to_db(SingleAgentWellResult, wells)
+def sa_wells_to_db(wells, append=False):
+    to_db(SingleAgentWellResult, wells, append)
 
 
 if __name__ == '__main__':
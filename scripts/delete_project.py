@@ -1,53 +1,80 @@
+import time
+
+import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
+import analytics
 from models import Model, Drug, Combination, MatrixResult, WellResult, \
-    DoseResponseCurve, SingleAgentWellResult, Project
+    MatrixWellArray, DoseResponseCurve, SingleAgentWellResult, Project, \
+    UploadCheckpoint, DataVersion
 
 from db import engine
 Session = sessionmaker(bind=engine)
 session = Session()
 
 
-def delete_by_barcodes(model, barcodes):
-
-    session.query(model).filter(model.barcode.in_(barcodes)).delete(synchronize_session=False)
-
+def project_barcodes(project):
+    """Subquery of the barcodes of `project`'s matrix results"""
+    return sa.select([MatrixResult.barcode]).where(
+        MatrixResult.project_id == project.id)
 
-def delete_project_barcodes(barcodes):
 
-    def delete_pb(model):
-        delete_by_barcodes(model, barcodes)
+def delete_rows(model, condition):
+    """Delete the rows of `model`'s table matching `condition`, with timing"""
+    start = time.time()
+    deleted = session.execute(model.__table__.delete().where(condition)).rowcount
+    print(f"Deleted {deleted} rows from {model.__tablename__} "
+          f"in {time.time() - start:.2f}s")
+    return deleted
 
-    return delete_pb
 
+def delete_project(name, vacuum=False):
+    """
+    Delete a project, its results and the drugs and models no other project
+    uses, in a single transaction.
 
-def delete_project(name):
-
-    project = session.query(Project).filter_by(name=name).one()
+    Each table is cleared with one set-based DELETE, by project id or by a
+    subquery on the project's barcodes, and orphaned drugs and models are
+    found with NOT EXISTS, so no ids are collected in Python. With `vacuum`
+    set, the space freed is reclaimed from the database file afterwards.
+    """
+    # on a database from before the DataVersion, which the deletion increases
+    DataVersion.__table__.create(engine, checkfirst=True)
+    project = session.query(Project).filter_by(name=name).one_or_none()
 
     if not project:
         raise NoResultFound(f"No project found with name {name}")
 
+    barcodes = project_barcodes(project)
 
-    project_barcodes = {b[0] for b in session.query(MatrixResult.barcode.distinct()).filter(MatrixResult.project == project).all()}
-
-    model_barcode_deleter = delete_project_barcodes(project_barcodes)
+    delete_rows(DoseResponseCurve, DoseResponseCurve.project_id == project.id)
+    delete_rows(SingleAgentWellResult, SingleAgentWellResult.barcode.in_(barcodes))
+    delete_rows(WellResult, WellResult.barcode.in_(barcodes))
+    delete_rows(MatrixWellArray, MatrixWellArray.barcode.in_(barcodes))
+    delete_rows(MatrixResult, MatrixResult.project_id == project.id)
+    delete_rows(Combination, Combination.project_id == project.id)
 
-    model_barcode_deleter(DoseResponseCurve)
-    model_barcode_deleter(SingleAgentWellResult)
-    model_barcode_deleter(WellResult)
-    model_barcode_deleter(MatrixResult)
+    combinations = Combination.__table__
+    delete_rows(Drug, sa.and_(
+        ~sa.exists().where(combinations.c.lib1_id == Drug.id),
+        ~sa.exists().where(combinations.c.lib2_id == Drug.id)))
+    delete_rows(Model, ~sa.exists().where(MatrixResult.model_id == Model.id))
 
-    session.query(Combination).filter(Combination.project == project).delete(synchronize_session=False)
-
-    drugs_in_use = {i for combo in session.query(Combination.lib1_id, Combination.lib2_id).distinct().all() for i in combo}
-    session.query(Drug).filter(Drug.id.notin_(drugs_in_use)).delete(synchronize_session=False)
-
-    models_in_use = {m[0] for m in session.query(MatrixResult.model_id).distinct().all()}
-    session.query(Model).filter(Model.id.notin_(models_in_use)).delete(synchronize_session=False)
+    delete_rows(UploadCheckpoint, UploadCheckpoint.project_id == project.id)
 
     session.delete(project)
+    DataVersion.increment(session)
 
     session.commit()
+    analytics.warn_stale_export()
+
+    if vacuum:
+        reclaim_space()
+
 
+def reclaim_space():
+    start = time.time()
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute('VACUUM')
+    print(f"Vacuumed database in {time.time() - start:.2f}s")
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Readers for the project upload input files.
+
+Inputs can be CSV, Parquet or Arrow IPC (Feather) files. The format is
+taken from the file extension. CSV files may be gzip (.csv.gz) or zstd
+(.csv.zst) compressed: they are decompressed as a stream on a background
+thread, a few blocks ahead of the parser, and never written to disk. Column
+selections (`usecols`) are either a list of column names or a callable on a
+column name, as for `pandas.read_csv`, and are pushed down into the
+Parquet/Arrow readers so that unused columns are never read. Column types
+(`dtype`) are a mapping of column name to dtype, as for `pandas.read_csv`;
+columns missing from the input are ignored.
+'''
+
+import gzip
+import io
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+COLUMNAR_FORMATS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'ipc',
+    '.feather': 'ipc',
+    '.ipc': 'ipc',
+}
+
+COMPRESSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+
+def input_compression(path):
+    return COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def input_format(path):
+    if input_compression(path):
+        path = os.path.splitext(path)[0]
+    return COLUMNAR_FORMATS.get(os.path.splitext(path)[1].lower(), 'csv')
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Reading Parquet or Arrow inputs requires pyarrow "
+                          "(pip install pyarrow)")
+    return pyarrow
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading zstd compressed inputs requires zstandard "
+                          "(pip install zstandard)")
+    return zstandard
+
+
+class PrefetchReader(io.RawIOBase):
+    """
+    Read `source` on a background thread, `block_size` bytes at a time and
+    at most `blocks` blocks ahead of the consumer, so that producing the
+    bytes (e.g. decompressing them) overlaps with consuming them.
+    """
+
+    def __init__(self, source, block_size=1 << 20, blocks=8):
+        super().__init__()
+        self._queue = queue.Queue(maxsize=blocks)
+        self._block = memoryview(b'')
+        self._eof = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch,
+                                        args=(source, block_size), daemon=True)
+        self._thread.start()
+
+    def _prefetch(self, source, block_size):
+        try:
+            with source:
+                while not self._stopped.is_set():
+                    block = source.read(block_size)
+                    self._put(block)
+                    if not block:
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._block:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._block = memoryview(item)
+        n = min(len(buffer), len(self._block))
+        buffer[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        super().close()
+
+
+@contextmanager
+def open_csv(path):
+    """
+    `path` itself for plain CSV files, or a binary stream of the decompressed
+    contents of a compressed one, for `pandas.read_csv`
+    """
+    compression = input_compression(path)
+    if compression is None:
+        yield path
+        return
+
+    if compression == 'gzip':
+        source = gzip.open(path, 'rb')
+    else:
+        source = import_zstandard().ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True)
+
+    with io.BufferedReader(PrefetchReader(source), buffer_size=1 << 20) as stream:
+        yield stream
+
+
+def check_uncompressed(path):
+    if input_compression(path):
+        raise ValueError(f"{path}: only CSV inputs can be compressed, Parquet "
+                         f"and Arrow files use their own internal compression")
+
+
+def columnar_schema(path):
+    """Column names of a Parquet or Arrow IPC file, read from its footer"""
+    check_uncompressed(path)
+    pa = import_pyarrow()
+    if input_format(path) == 'parquet':
+        return pa.parquet.read_schema(path).names
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def input_columns(path):
+    """Column names of an input file, without reading its rows"""
+    if input_format(path) == 'csv':
+        with open_csv(path) as csv:
+            return list(pd.read_csv(csv, nrows=0).columns)
+    return columnar_schema(path)
+
+
+def project_columns(columns, usecols):
+    if usecols is None:
+        return list(columns)
+    if callable(usecols):
+        return [c for c in columns if usecols(c)]
+    missing = set(usecols) - set(columns)
+    if missing:
+        raise ValueError(f"Columns missing from input: {sorted(missing)}")
+    return [c for c in columns if c in set(usecols)]
+
+
+def apply_dtypes(df, dtype):
+    if not dtype:
+        return df
+    return df.astype({c: t for c, t in dtype.items() if c in df.columns})
+
+
+def read_input(path, usecols=None, dtype=None):
+    """Read a whole input file, keeping only the columns in `usecols`"""
+    fmt = input_format(path)
+    if fmt == 'csv':
+        with open_csv(path) as csv:
+            return pd.read_csv(csv, usecols=usecols, dtype=dtype)
+    check_uncompressed(path)
+
+    pa = import_pyarrow()
+    columns = project_columns(columnar_schema(path), usecols)
+    if fmt == 'parquet':
+        table = pa.parquet.read_table(path, columns=columns)
+    else:
+        table = pa.feather.read_table(path, columns=columns)
+    return apply_dtypes(table.to_pandas(), dtype)
+
+
+def read_input_chunks(path, chunksize, usecols=None, dtype=None):
+    """Iterate over an input file in DataFrames of at most `chunksize` rows"""
+    fmt = input_format(path)
+    if fmt == 'csv':
+        with open_csv(path) as csv:
+            for chunk in pd.read_csv(csv, chunksize=chunksize, usecols=usecols,
+                                     dtype=dtype):
+                yield chunk
+        return
+    check_uncompressed(path)
+
+    pa = import_pyarrow()
+    columns = project_columns(columnar_schema(path), usecols)
+    if fmt == 'parquet':
+        parquet_file = pa.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                               columns=columns):
+            yield apply_dtypes(batch.to_pandas(), dtype)
+        return
+
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = pa.Table.from_batches([reader.get_batch(i)]).select(columns)
+            for offset in range(0, batch.num_rows, chunksize):
+                yield apply_dtypes(batch.slice(offset, chunksize).to_pandas(),
+                                   dtype)
+
+
+def memory_usage(df):
+    """
+    Deep memory usage of `df` in bytes, and an estimate of its usage with the
+    types pandas infers by default: object for categoricals and 64 bit
+    numbers.
+    """
+    used = inferred = 0
+    for column in df.columns:
+        values = df[column]
+        used += values.memory_usage(deep=True, index=False)
+        if pd.api.types.is_categorical_dtype(values):
+            values = values.astype(object)
+        elif pd.api.types.is_integer_dtype(values):
+            values = values.astype('int64')
+        elif pd.api.types.is_float_dtype(values):
+            values = values.astype('float64')
+        inferred += values.memory_usage(deep=True, index=False)
+    return used, inferred
+
+
+def write_columnar(df, path):
+    """Write `df` as Parquet or Arrow IPC, depending on the extension of `path`"""
+    pa = import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if input_format(path) == 'parquet':
+        pa.parquet.write_table(table, path)
+    else:
+        pa.feather.write_feather(table, path)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+!!! Run this program using gdscmatrixexplorer/cli.py !!!
+
+Bring databases created by earlier versions up to date with models.py,
+and check that the page queries use the indexes declared there.
+'''
+
+import re
+import time
+
+import sqlalchemy as sa
+
+from db import engine, Base, read_sql
+from models import MatrixResult, WellResult, MatrixWellArray, \
+    SingleAgentWellResult, DoseResponseCurve, Project, label_properties
+from scripts.db_loader import pack_matrix_wells
+
+
+# The per-matrix lookups of the matrix pages, which must not scan their table
+LOOKUP_QUERIES = {
+    'well results of a matrix': sa.select([WellResult.__table__]).where(sa.and_(
+        WellResult.barcode == 0, WellResult.drugset_id == 0,
+        WellResult.cmatrix == 0)),
+    'single agent wells of a curve': sa.select([SingleAgentWellResult.__table__]).where(sa.and_(
+        SingleAgentWellResult.barcode == 0, SingleAgentWellResult.lib_drug == '',
+        SingleAgentWellResult.drugset_id == 0)),
+    'single agent wells of a tag': sa.select([SingleAgentWellResult.__table__]).where(sa.and_(
+        SingleAgentWellResult.barcode == 0, SingleAgentWellResult.lib_drug == '')),
+    'replicates of a matrix': sa.select([MatrixResult.__table__]).where(
+        MatrixResult.replicate_group == ''),
+    'curves of a matrix': sa.select([DoseResponseCurve.__table__]).where(sa.and_(
+        DoseResponseCurve.barcode == 0, DoseResponseCurve.tag.in_(['', '']))),
+}
+
+
+def create_indexes():
+    """Create the indexes declared in models.py that the database lacks"""
+    Base.metadata.create_all(engine)
+    inspector = sa.inspect(engine)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                start = time.time()
+                index.create(bind=engine)
+                print(f"Created index {index.name} in {time.time() - start:.1f}s")
+                created.append(index)
+        if any(index.table is table for index in created):
+            engine.execute(f"ANALYZE {table.name}")
+    if not created:
+        print("All indexes exist")
+    return created
+
+
+def enable_wal():
+    """
+    Switch the SQLite database to WAL journaling, which the file keeps,
+    so that the DB_READ_ONLY web workers read while an upload writes
+    """
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError("WAL journaling only applies to SQLite")
+    journal_mode = engine.execute("PRAGMA journal_mode=WAL").scalar()
+    print(f"Journal mode: {journal_mode}")
+    return journal_mode
+
+
+def query_plan(statement):
+    """The SQLite query plan of `statement`, one line per step"""
+    compiled = statement.compile(dialect=engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    return [row[-1] for row in
+            engine.execute(f"EXPLAIN QUERY PLAN {compiled}", params)]
+
+
+def check_query_plans():
+    """
+    Check that each of the LOOKUP_QUERIES searches its table with an index.
+    Only the steps on the queried table count, not those of the subqueries
+    looking up a label's id. Returns the names of the queries that scan
+    instead.
+    """
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError("Query plans can only be checked on SQLite")
+
+    scanning = []
+    for name, statement in LOOKUP_QUERIES.items():
+        plan = query_plan(statement)
+        # e.g. SEARCH well_results USING INDEX ix_... (barcode=? AND ...),
+        # SEARCH TABLE well_results ... on SQLite before 3.36
+        table = re.escape(statement.froms[0].name)
+        uses_index = any(re.match(rf"SEARCH (TABLE )?{table} USING (COVERING )?INDEX ", step)
+                         for step in plan) and \
+            not any(re.match(rf"SCAN (TABLE )?{table}\b", step) for step in plan)
+        print(f"{'OK  ' if uses_index else 'SCAN'} {name}: {'; '.join(plan)}")
+        if not uses_index:
+            scanning.append(name)
+    return scanning
+
+
+def backfill_matrix_well_arrays(project_name=None):
+    """
+    Pack the wells of the matrices that have no MatrixWellArray yet, e.g.
+    those uploaded before arrays were packed, optionally of one project.
+    """
+    Base.metadata.create_all(engine)
+    arrays = MatrixWellArray.__table__
+    query = sa.select([MatrixResult.barcode]).distinct().where(
+        ~sa.exists().where(sa.and_(arrays.c.barcode == MatrixResult.barcode,
+                                   arrays.c.drugset_id == MatrixResult.drugset_id,
+                                   arrays.c.cmatrix == MatrixResult.cmatrix)))
+    if project_name is not None:
+        query = query.where(MatrixResult.project_id == sa.select([Project.id])
+                            .where(Project.name == project_name).as_scalar())
+    barcodes = [b for (b,) in engine.execute(query)]
+    print(f"{len(barcodes)} barcodes with matrices to pack")
+    start = time.time()
+    packed = pack_matrix_wells(barcodes)
+    print(f"Backfilled in {time.time() - start:.1f}s")
+    return packed
+
+
+def add_replicate_groups():
+    """
+    Add the MatrixResult.replicate_group column to a database created
+    before it existed, set it for the matrices that lack it and index it
+    """
+    Base.metadata.create_all(engine)
+    table = MatrixResult.__table__
+    column = table.c.replicate_group
+    if column.name not in {c['name'] for c in sa.inspect(engine).get_columns(table.name)}:
+        engine.execute(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                       f"{column.type.compile(engine.dialect)}")
+        print(f"Added column {table.name}.{column.name}")
+
+    keys = [table.c.barcode, table.c.drugset_id, table.c.cmatrix]
+    matrices = read_sql(sa.select(keys + [table.c.lib1_id, table.c.lib2_id,
+                                          table.c.model_id])
+                        .where(column.is_(None)))
+    start = time.time()
+    if not matrices.empty:
+        matrices['group'] = MatrixResult.replicate_group_of(
+            matrices.lib1_id, matrices.lib2_id, matrices.model_id)
+        # bind parameters named apart from the columns being updated
+        rows = matrices.rename(columns={k.name: f"_{k.name}" for k in keys})\
+            .astype(object).to_dict('records')
+        with engine.begin() as conn:
+            conn.execute(
+                table.update()
+                .where(sa.and_(*[k == sa.bindparam(f"_{k.name}") for k in keys]))
+                .values({column.name: sa.bindparam('group')}),
+                rows)
+    print(f"Grouped {len(matrices)} matrices in {time.time() - start:.1f}s")
+    create_indexes()
+    return len(matrices)
+
+
+def encode_well_labels():
+    """
+    Rebuild the well tables of a database created before their tags and
+    doses were stored by id (see models.label_property). Prints the size
+    of each table and the time of a scan of it before and after.
+    """
+    Base.metadata.create_all(engine)
+    results = []
+    for model in (WellResult, SingleAgentWellResult):
+        table = model.__table__
+        stored = {c['name'] for c in sa.inspect(engine).get_columns(table.name)}
+        labels = {id_column: (name, lookup) for name, id_column, lookup
+                  in label_properties(model) if name in stored}
+        if not labels:
+            print(f"{table.name} already stores labels by id")
+            continue
+
+        before = table_size(table.name), scan_seconds(table.name)
+        start = time.time()
+        with engine.begin() as conn:
+            rebuild_with_label_ids(conn, table, labels)
+        print(f"Rebuilt {table.name} in {time.time() - start:.1f}s")
+        results.append((table.name, before))
+
+    if not results:
+        return []
+    create_indexes()
+    if engine.dialect.name == 'sqlite':
+        print("Vacuuming")
+        engine.execute("VACUUM")
+
+    report = []
+    for name, (size, seconds) in results:
+        after = table_size(name), scan_seconds(name)
+        report.append(dict(table=name, size_mb_before=size, size_mb_after=after[0],
+                           scan_seconds_before=seconds, scan_seconds_after=after[1]))
+        print(f"{name}: {size:.1f}MB -> {after[0]:.1f}MB, "
+              f"scan {seconds:.2f}s -> {after[1]:.2f}s")
+    return report
+
+
+def rebuild_with_label_ids(conn, table, labels):
+    """
+    Copy `table` into a new table as models.py defines it, constraints
+    included, replacing the label columns by the ids of `labels` ({id
+    column: (label column, lookup)}), and put the copy in its place. Its
+    indexes are dropped with it, for create_indexes to rebuild.
+    """
+    old = sa.Table(table.name, sa.MetaData(), autoload=True, autoload_with=conn)
+    for name, lookup in set(labels.values()):
+        known = sa.select([lookup.label])
+        conn.execute(lookup.__table__.insert().from_select(
+            ['label'], sa.select([old.c[name]]).distinct()
+            .where(old.c[name].isnot(None)).where(~old.c[name].in_(known))))
+
+    # The tables its foreign keys refer to go along, for them to resolve
+    metadata = sa.MetaData()
+    for referred in {fk.column.table for fk in table.foreign_keys}:
+        referred.tometadata(metadata)
+    encoded = table.tometadata(metadata, name=f"{table.name}_encoded")
+    # the old table's indexes still hold their names
+    encoded.indexes.clear()
+    encoded.create(conn)
+
+    source, values = old, []
+    for column in table.columns:
+        if column.name not in labels:
+            values.append(old.c[column.name])
+            continue
+        name, lookup = labels[column.name]
+        ids = lookup.__table__.alias(f"{column.name}_lookup")
+        source = source.outerjoin(ids, ids.c.label == old.c[name])
+        values.append(ids.c.id)
+    conn.execute(encoded.insert().from_select(
+        [c.name for c in table.columns], sa.select(values).select_from(source)))
+
+    if engine.dialect.name == 'postgresql':
+        # the copied ids were not drawn from the new table's sequence
+        conn.execute(f"SELECT setval(pg_get_serial_sequence('{encoded.name}', 'id'), "
+                     f"COALESCE(MAX(id), 0) + 1, false) FROM {encoded.name}")
+    conn.execute(f"DROP TABLE {table.name}")
+    conn.execute(f"ALTER TABLE {encoded.name} RENAME TO {table.name}")
+    if engine.dialect.name == 'postgresql':
+        rename_after_table(conn, encoded.name, table.name)
+
+
+def rename_after_table(conn, old_name, name):
+    """
+    Give the constraints and id sequence PostgreSQL named after table
+    `old_name`, since renamed to `name`, the names they would have had
+    """
+    constraints = conn.execute(
+        "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass", name)
+    for (constraint,) in constraints.fetchall():
+        if constraint.startswith(old_name):
+            conn.execute(f"ALTER TABLE {name} RENAME CONSTRAINT {constraint} "
+                         f"TO {name}{constraint[len(old_name):]}")
+    sequence = conn.execute("SELECT pg_get_serial_sequence(%s, 'id')", name).scalar()
+    if sequence:
+        conn.execute(f"ALTER SEQUENCE {sequence} RENAME TO {name}_id_seq")
+
+
+def table_size(name):
+    """The size in MB of table `name` with its indexes"""
+    if engine.dialect.name == 'postgresql':
+        size = engine.execute(f"SELECT pg_total_relation_size('{name}')").scalar()
+    else:
+        # needs SQLite's dbstat table, which most builds include
+        size = engine.execute(
+            "SELECT SUM(pgsize) FROM dbstat JOIN sqlite_master AS m "
+            "ON dbstat.name = m.name WHERE m.tbl_name = ?", name).scalar()
+    return size / 1024 ** 2
+
+
+def scan_seconds(name, rounds=3):
+    """The best time of `rounds` scans of table `name`, aggregating a column of every row"""
+    seconds = []
+    for _ in range(rounds):
+        start = time.time()
+        engine.execute(f"SELECT COUNT(*), MIN(inhibition), MAX(inhibition) "
+                       f"FROM {name}").fetchall()
+        seconds.append(time.time() - start)
+    return min(seconds)
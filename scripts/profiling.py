@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Per-stage profiling of project uploads.
+
+`upload_project` runs each stage inside `UploadProfile.stage`, and the
+database writers of scripts.db_loader report their rows through
+`count_rows`. For every stage the profile records:
+
+- seconds: wall time
+- rows_in: rows handed to the database writers, or compared with the
+  stored rows by `get_new`
+- rows_out: rows inserted or updated (new or changed rows in append mode)
+- rows_per_second: rows_in per second of wall time
+- peak_rss_mb: peak resident memory of the loader process so far, and of
+  its worker processes (see upload_project's ``workers``)
+'''
+
+import datetime
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+_active_stage = None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def count_rows(rows_in, rows_out):
+    """Add to the row counts of the stage being profiled, if any"""
+    if _active_stage is not None:
+        _active_stage['rows_in'] += int(rows_in)
+        _active_stage['rows_out'] += int(rows_out)
+
+
+class UploadProfile:
+    def __init__(self, project_name, **options):
+        self.project_name = project_name
+        self.options = options
+        self.started_at = datetime.datetime.now()
+        self.start = time.time()
+        self.stages = []
+        self.memory = {}
+
+    @contextmanager
+    def stage(self, name):
+        global _active_stage
+        record = dict(name=name, seconds=None, rows_in=0, rows_out=0)
+        start = time.time()
+        _active_stage = record
+        try:
+            yield record
+        finally:
+            _active_stage = None
+            record['seconds'] = time.time() - start
+            record['rows_per_second'] = record['rows_in'] / max(record['seconds'], 1e-6)
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_mb_workers'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+            self.stages.append(record)
+            print(f"Stage {name} done in {record['seconds']:.1f}s "
+                  f"({record['rows_in']} rows in, {record['rows_out']} rows out)")
+
+    def skip(self, name):
+        self.stages.append(dict(name=name, skipped=True))
+
+    def report(self):
+        return {
+            'project': self.project_name,
+            'started_at': self.started_at.isoformat(),
+            'options': self.options,
+            'seconds': time.time() - self.start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': self.stages,
+            'input_frame_memory': {
+                name: {'bytes': used, 'inferred_bytes': inferred}
+                for name, (used, inferred) in self.memory.items()
+            },
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Profile written to {path}")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+!!! Run this program using gdscmatrixexplorer/cli.py !!!
+
+Checks the combo matrix, combo well and NLME stats files of a project
+before upload, without touching the database. Every check is a vectorized
+groupby or merge over the whole file, so broken inputs are reported in
+seconds rather than halfway through `upload_project`.
+'''
+
+import re
+
+import pandas as pd
+
+from scripts.db_loader import MATRIX_STATS_COLUMNS, WELL_STATS_COLUMNS, \
+    NLME_CURVE_COLUMNS, NLME_WELL_COLUMNS, WELL_STATS_DTYPES, NLME_STATS_DTYPES, \
+    read_matrix_stats
+from scripts.input_files import input_columns, read_input
+
+# extract_models only copies these model columns if they are present
+OPTIONAL_MATRIX_STATS_COLUMNS = ['TISSUE', 'CANCER_TYPE', 'COSMIC_ID']
+
+MATRIX_KEY = ['BARCODE', 'DRUGSET_ID', 'cmatrix']
+WELL_KEY = MATRIX_KEY + ['POSITION']
+CURVE_KEY = ['BARCODE', 'DRUGSET_ID', 'lib_drug']
+SINGLE_AGENT_WELL_KEY = CURVE_KEY + ['POSITION']
+
+EXAMPLES = 5
+
+
+def validate_project_files(combo_matrix_stats_path, combo_well_stats_path,
+                           nlme_stats_path):
+    """
+    Validate the input files of `upload_project`, print every problem found
+    and return the list of errors. Warnings are printed but not returned.
+    """
+    errors, warnings = [], []
+
+    required = {
+        combo_matrix_stats_path: [c for c in MATRIX_STATS_COLUMNS
+                                  if c not in OPTIONAL_MATRIX_STATS_COLUMNS]
+                                 + ['lib1_MaxE', 'lib2_MaxE'],
+        combo_well_stats_path: WELL_STATS_COLUMNS,
+        nlme_stats_path: NLME_CURVE_COLUMNS + NLME_WELL_COLUMNS,
+    }
+    for path, columns in required.items():
+        missing = sorted(set(columns) - set(input_columns(path)))
+        if missing:
+            errors.append(f"{path}: missing columns {', '.join(missing)}")
+    if errors:
+        return report(errors, warnings)
+
+    try:
+        matrices = read_matrix_stats(combo_matrix_stats_path)
+        wells = read_input(combo_well_stats_path, usecols=WELL_STATS_COLUMNS,
+                           dtype=WELL_STATS_DTYPES).drop_duplicates()
+        nlme_stats = read_input(nlme_stats_path,
+                                usecols=NLME_CURVE_COLUMNS + NLME_WELL_COLUMNS,
+                                dtype=NLME_STATS_DTYPES)
+    except ValueError as e:
+        # e.g. missing or non-numeric values in an id column
+        return report(errors + [f"Unreadable input: {e}"], warnings)
+
+    curves = nlme_stats[NLME_CURVE_COLUMNS].drop_duplicates()
+    sa_wells = nlme_stats[NLME_WELL_COLUMNS].drop_duplicates()
+
+    errors += duplicate_keys('combo matrix stats', matrices, MATRIX_KEY)
+    errors += duplicate_keys('combo well stats', wells, WELL_KEY)
+    errors += duplicate_keys('NLME curves', curves, CURVE_KEY)
+    errors += duplicate_keys('NLME single agent wells', sa_wells,
+                             SINGLE_AGENT_WELL_KEY)
+    errors += wells_per_matrix(matrices, wells)
+    errors += unmatched('combo wells without a matrix', wells[MATRIX_KEY],
+                        matrices[MATRIX_KEY], MATRIX_KEY)
+    errors += unmatched('library drugs without an NLME curve',
+                        library_tags(matrices), curves[CURVE_KEY], CURVE_KEY)
+    warnings += unmatched('NLME curves without a combination (not uploaded)',
+                          curves[CURVE_KEY], library_tags(matrices), CURVE_KEY)
+
+    return report(errors, warnings)
+
+
+def report(errors, warnings):
+    for warning in warnings:
+        print(f"WARNING: {warning}")
+    for error in errors:
+        print(f"ERROR: {error}")
+    if not errors:
+        print("Input files are valid")
+    return errors
+
+
+def examples(df):
+    rows = df.head(EXAMPLES).astype(object).to_dict('records')
+    more = f" and {len(df) - EXAMPLES} more" if len(df) > EXAMPLES else ""
+    return f"{rows}{more}"
+
+
+def duplicate_keys(name, df, key):
+    """Keys of `df` on more than one row"""
+    duplicated = df[df.duplicated(subset=key, keep=False)][key].drop_duplicates()
+    if duplicated.empty:
+        return []
+    return [f"{name}: {len(duplicated)} duplicated keys, e.g. {examples(duplicated)}"]
+
+
+def expected_wells(matrix_size):
+    """Wells of a matrix of `matrix_size`, e.g. '7x7' or 7 (square)"""
+    sides = [int(s) for s in re.findall(r'\d+', str(matrix_size))]
+    if len(sides) == 1:
+        return sides[0] ** 2
+    return sides[0] * sides[1] if len(sides) == 2 else None
+
+
+def wells_per_matrix(matrices, wells):
+    """Matrices whose number of distinct well positions is not their size"""
+    counts = wells.groupby(MATRIX_KEY).POSITION.nunique()\
+        .rename('wells').reset_index()
+    sizes = matrices[MATRIX_KEY + ['matrix_size']]\
+        .drop_duplicates(subset=MATRIX_KEY)\
+        .astype({'matrix_size': object})
+    sizes['expected_wells'] = sizes.matrix_size.map(
+        {s: expected_wells(s) for s in sizes.matrix_size.unique()})
+
+    checked = sizes.merge(counts, on=MATRIX_KEY, how='left')
+    checked['wells'] = checked.wells.fillna(0).astype(int)
+
+    errors = []
+    unparsed = checked[checked.expected_wells.isnull()]
+    if not unparsed.empty:
+        errors.append(f"combo matrix stats: {len(unparsed)} matrices with an "
+                      f"unknown matrix_size, e.g. {examples(unparsed)}")
+    wrong = checked[checked.expected_wells.notnull() &
+                    (checked.wells != checked.expected_wells)]
+    if not wrong.empty:
+        errors.append(f"combo well stats: {len(wrong)} matrices with the wrong "
+                      f"number of wells, e.g. {examples(wrong)}")
+    return errors
+
+
+def library_tags(matrices):
+    """The (barcode, drugset, tag) of both library drugs of every matrix"""
+    tags = [matrices[['BARCODE', 'DRUGSET_ID', lib]].rename(columns={lib: 'lib_drug'})
+            for lib in ('lib1', 'lib2')]
+    return pd.concat([without_categories(t) for t in tags]).drop_duplicates()
+
+
+def without_categories(df):
+    """`df` with categorical columns as objects, so that they merge on values"""
+    return df.astype({c: object for c in df.columns
+                      if pd.api.types.is_categorical_dtype(df[c])})
+
+
+def unmatched(name, df, other, key):
+    """Distinct `key`s of `df` that are not in `other`"""
+    merged = without_categories(df).drop_duplicates()\
+        .merge(without_categories(other).drop_duplicates(), on=key,
+               how='left', indicator=True)
+    missing = merged[merged._merge == 'left_only'][key]
+    if missing.empty:
+        return []
+    return [f"{name}: {len(missing)}, e.g. {examples(missing)}"]
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# The modules create their engine when imported, from DATABASE_URL: point
+# it at an empty SQLite database before any test imports them
+TEST_DATA_PATH = tempfile.mkdtemp(prefix='matrixexplorer-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{TEST_DATA_PATH}/matrixexplorer.db"
+os.environ['SIDM_CACHE_PATH'] = f"{TEST_DATA_PATH}/sidm_cache.json"
+os.environ['ANALYTICS_PATH'] = f"{TEST_DATA_PATH}/analytics"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from db import Session, count_statements
+from scripts import db_loader, migrations
+
+# SQL statements of a matrix page render, on cold and on warm caches
+MAX_STATEMENTS = 13
+MAX_CACHED_STATEMENTS = 9
+
+BARCODE = 10000
+TAGS = ['L1001', 'L1002', 'L1003']
+
+
+def project_files(path):
+    """The matrix, well and NLME stats of 2 matrices of a plate, as CSV files"""
+    rng = np.random.RandomState(0)
+    matrices, wells, nlme = [], [], []
+    for cmatrix, (tag1, tag2) in enumerate(zip(TAGS, TAGS[1:]), start=1):
+        matrix = dict(CELL_LINE_NAME='CL0', TISSUE='Lung', CANCER_TYPE='LUAD',
+                      MASTER_CELL_ID=900, COSMIC_ID=9000, DRUGSET_ID=1,
+                      cmatrix=cmatrix, BARCODE=BARCODE, lib1=tag1, lib2=tag2,
+                      lib1_ID=int(tag1[1:]), lib2_ID=int(tag2[1:]), matrix_size='7x7',
+                      combo_MaxE=0.5, Delta_MaxE_lib1=0.1, Delta_MaxE_lib2=0.1,
+                      Delta_combo_MaxE_day1=0.1, day1_viability_mean=0.8,
+                      day1_intensity_mean=1000.0, day1_inhibition_scale=0.1,
+                      growth_rate=0.5, doubling_time=30.0)
+        for lib, tag in (('lib1', tag1), ('lib2', tag2)):
+            matrix.update({f'{lib}_name': f'Drug {tag}', f'{lib}_target': 'T',
+                           f'{lib}_pathway': 'P', f'{lib}_owner': 'O',
+                           f'{lib}_MaxE': 0.3})
+        for metric in ('HSA', 'Bliss'):
+            matrix.update({f'{metric}_synergistic_wells': 3, f'{metric}_matrix': 0.1,
+                           f'{metric}_matrix_SO': 0.1, f'{metric}_window_size': 3,
+                           f'{metric}_window': 0.1, f'{metric}_window_dose1': 'D1-D3',
+                           f'{metric}_window_dose2': 'D1-D3', f'{metric}_window_SO': 0.1,
+                           f'{metric}_window_SO_dose1': 'D2-D4',
+                           f'{metric}_window_SO_dose2': 'D2-D4'})
+        matrices.append(matrix)
+
+        position = cmatrix * 100
+        for i in range(7):
+            for j in range(7):
+                position += 1
+                wells.append(dict(DRUGSET_ID=1, cmatrix=cmatrix, BARCODE=BARCODE,
+                                  POSITION=position, lib1=tag1, lib1_dose=f'D{i + 1}',
+                                  lib1_conc=0.01 * 2 ** i, lib2=tag2,
+                                  lib2_dose=f'D{j + 1}', lib2_conc=0.02 * 2 ** j,
+                                  inhibition=rng.rand(), HSA=rng.rand(),
+                                  HSA_excess=rng.rand() - 0.5,
+                                  Bliss_additivity=rng.rand(),
+                                  Bliss_excess=rng.rand() - 0.5))
+
+    for position, tag in enumerate(TAGS):
+        for k in range(7):
+            nlme.append(dict(BARCODE=BARCODE, DRUGSET_ID=1, xmid=5.0, scal=1.0,
+                             RMSE=0.1, IC50=1.0, auc=0.7, maxc=1.0, lib_drug=tag,
+                             POSITION=position * 10 + k, y=rng.rand(),
+                             x_micromol=0.01 * 2 ** k))
+
+    paths = [str(path / name) for name in ('matrix.csv', 'wells.csv', 'nlme.csv')]
+    for frame, file_path in zip((matrices, wells, nlme), paths):
+        pd.DataFrame(frame).to_csv(file_path, index=False)
+    return paths
+
+
+@pytest.fixture(scope='module')
+def matrix_paths(tmp_path_factory):
+    migrations.create_indexes()
+    get_sidm = db_loader.get_sidm
+    db_loader.get_sidm = lambda identifier, *args, **kwargs: f"SIDM{int(identifier):05d}"
+    try:
+        db_loader.upload_project(*project_files(tmp_path_factory.mktemp('project')),
+                                 'Test Project')
+    finally:
+        db_loader.get_sidm = get_sidm
+    return [f'/matrix/{BARCODE}/{cmatrix}' for cmatrix in (1, 2)]
+
+
+def render_statements(path):
+    """The SQL statements of a render of the matrix page at `path`"""
+    from pages import matrix
+
+    with count_statements() as counter:
+        layout = matrix.layout(path)
+    Session.remove()
+    assert 'not found' not in str(layout).lower()
+    return counter['statements']
+
+
+def test_matrix_page_statements(matrix_paths):
+    for path in matrix_paths:
+        assert render_statements(path) <= MAX_STATEMENTS
+        assert render_statements(path) <= MAX_CACHED_STATEMENTS
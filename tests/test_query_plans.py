@@ -0,0 +1,6 @@
+from scripts import migrations
+
+
+def test_matrix_page_lookups_use_an_index():
+    migrations.create_indexes()
+    assert migrations.check_query_plans() == []
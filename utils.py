@@ -1,16 +1,21 @@
 import math
 import re
-from functools import lru_cache
+from collections import namedtuple
+from functools import lru_cache, wraps
 
 import dash_core_components as dcc
 import dash_html_components as html
 import pandas as pd
 import sqlalchemy as sa
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 
-from db import session
+import analytics
+from db import Base, session
 import models
 
+CachedInstance = namedtuple('CachedInstance', ['model', 'identity'])
+
 
 class Colors:
     LIGHTGREEN = "rgb(117,171,61)"
@@ -178,10 +183,10 @@ viability_colorscale = [
 
 @lru_cache(20)
 def get_metric_min_max(metric):
-    return session.query(
-        func.min(getattr(models.WellResult, metric)).label('min_val'),
-        func.max(getattr(models.WellResult, metric)).label('max_val'))\
-        .one()
+    column = getattr(models.WellResult, metric)
+    ranges = analytics.read_sql(sa.select([func.min(column).label('min_val'),
+                                           func.max(column).label('max_val')]))
+    return tuple(None if pd.isnull(v) else v for v in ranges.iloc[0])
 
 
 def get_metric_axis_range(metric):
@@ -218,12 +223,35 @@ def get_project_metrics(project_id, metric):
             getattr(models.MatrixResult, metric))\
         .filter(models.MatrixResult.project_id == project_id)
 
-    project_matrix_metrics = pd.read_sql(
-        project_matrix_metrics_query.statement, session.bind)
+    project_matrix_metrics = analytics.read_sql(project_matrix_metrics_query.statement)
     return project_matrix_metrics
 
 
-@lru_cache()
+def lru_cache_instance(lookup):
+    """
+    Like lru_cache, but for lookups returning an ORM instance: cache its
+    class and primary key, and get the instance in the current request's
+    session, as the instance itself is detached when the session that loaded
+    it is removed. Other results (None, "not found" Divs) are cached as is.
+    """
+    @lru_cache()
+    def cached(*args):
+        result = lookup(*args)
+        if isinstance(result, Base):
+            return CachedInstance(type(result), sa.inspect(result).identity)
+        return result
+
+    @wraps(lookup)
+    def get(*args):
+        result = cached(*args)
+        if isinstance(result, CachedInstance):
+            return session.query(result.model).get(result.identity)
+        return result
+    get.cache_clear = cached.cache_clear
+    return get
+
+
+@lru_cache_instance
 def get_matrix_from_url(url):
     if not url.startswith("/matrix"):
         return None
@@ -243,7 +271,34 @@ def get_matrix_from_url(url):
     return matrix
 
 
-@lru_cache()
+def get_matrix_wells(barcode, drugset_id, cmatrix):
+    """
+    The well results of a matrix as a DataFrame of lib1_conc, lib2_conc and
+    the well metrics, from its packed MatrixWellArray in a single read, or
+    from its WellResult rows if it has none (not yet backfilled).
+    Callers must not modify the frame, which may be cached.
+    """
+    key = dict(barcode=barcode, drugset_id=drugset_id, cmatrix=cmatrix)
+    data = session.query(models.MatrixWellArray.data).filter_by(**key).scalar()
+    if data is not None:
+        return unpack_matrix_wells(bytes(data))
+
+    columns = ['lib1_conc', 'lib2_conc'] + models.MatrixWellArray.METRICS
+    query = session.query(*[getattr(models.WellResult, c) for c in columns])\
+        .filter_by(**key)
+    return pd.read_sql(query.statement, session.bind)
+
+
+@lru_cache(256)
+def unpack_matrix_wells(data):
+    """
+    MatrixWellArray.unpack, cached by the packed data itself, so that a
+    matrix packed again after an upload is never served its old wells
+    """
+    return models.MatrixWellArray.unpack(data)
+
+
+@lru_cache_instance
 def get_project_from_url(url):
     if not url.startswith("/project"):
         return None
@@ -254,7 +309,7 @@ def get_project_from_url(url):
     return session.query(models.Project).filter_by(slug=project_slug).one_or_none()
 
 
-@lru_cache()
+@lru_cache_instance
 def get_combination_from_url(url):
     if not url.startswith("/project"):
         return None
@@ -278,14 +333,90 @@ def get_combination_from_url(url):
     return combination
 
 
+class MatrixPageBundle:
+    """
+    What the matrix page shows of `matrix`, gathered in a few batched
+    queries rather than lazily by each component:
+
+    - matrix: the MatrixResult, with its project, model and drugs loaded
+    - curves: its single agent DoseResponseCurves
+    - datapoints: the single agent wells of each curve, by curve id
+    - day1_viability: the day 1 viability marked on each curve, by curve id
+    - wells: its well results (see get_matrix_wells)
+    - replicates: its replicates, with their projects loaded
+    - model_matrices: all matrices of its model, with their drugs loaded
+    """
+
+    def __init__(self, matrix):
+        MatrixResult = models.MatrixResult
+        Combination = models.Combination
+        with_drugs = [joinedload(MatrixResult.combination).joinedload(Combination.lib1),
+                      joinedload(MatrixResult.combination).joinedload(Combination.lib2)]
+
+        self.matrix = session.query(MatrixResult)\
+            .options(joinedload(MatrixResult.project),
+                     joinedload(MatrixResult.model), *with_drugs)\
+            .filter_by(barcode=matrix.barcode, drugset_id=matrix.drugset_id,
+                       cmatrix=matrix.cmatrix)\
+            .one()
+
+        self.curves = self.matrix.single_agent_curves
+        self.datapoints = self.get_datapoints()
+        self.day1_viability = self.get_day1_viability()
+        self.wells = get_matrix_wells(matrix.barcode, matrix.drugset_id, matrix.cmatrix)
+
+        self.replicates = self.matrix.all_replicates
+        self.model_matrices = session.query(MatrixResult)\
+            .options(*with_drugs)\
+            .filter(MatrixResult.model_id == self.matrix.model_id)\
+            .order_by(MatrixResult.barcode.desc())\
+            .all()
+
+    def get_datapoints(self):
+        """The single agent wells of all curves in one query, split by curve"""
+        SingleAgentWellResult = models.SingleAgentWellResult
+        query = session.query(SingleAgentWellResult).filter(
+            SingleAgentWellResult.barcode == self.matrix.barcode,
+            SingleAgentWellResult.lib_drug.in_({c.tag for c in self.curves}),
+            SingleAgentWellResult.drugset_id.in_({c.drugset_id for c in self.curves}))
+        wells = models.decode_labels(SingleAgentWellResult,
+                                     pd.read_sql(query.statement, session.bind))
+        return {c.id: wells[(wells.lib_drug == c.tag) &
+                            (wells.drugset_id == c.drugset_id)].reset_index(drop=True)
+                for c in self.curves}
+
+    def get_day1_viability(self):
+        """
+        The day 1 viability of the first matrix of each curve's barcode and
+        tag, as DoseResponseCurve.matrix_results[0] gives it
+        """
+        MatrixResult = models.MatrixResult
+        tags = [c.tag for c in self.curves]
+        matrices = session.query(MatrixResult.lib1_tag, MatrixResult.lib2_tag,
+                                 MatrixResult.day1_viability_mean)\
+            .filter(MatrixResult.barcode == self.matrix.barcode)\
+            .filter(sa.or_(MatrixResult.lib1_tag.in_(tags),
+                           MatrixResult.lib2_tag.in_(tags)))\
+            .order_by(MatrixResult.drugset_id, MatrixResult.cmatrix)\
+            .all()
+        return {c.id: next(m.day1_viability_mean for m in matrices
+                           if c.tag in (m.lib1_tag, m.lib2_tag))
+                for c in self.curves}
+
+
 def get_combination_link(combination):
     text = f"{combination.lib1.name} + {combination.lib2.name}"
     return dcc.Link(text, href=combination.url)
 
 
-@lru_cache()
 def get_combination_results_with_sa(combination):
-    all_cell_models = pd.read_sql_table('models', session.bind)\
+    # Only the models of the combination's matrices, not the whole table
+    combination_models = session.query(models.MatrixResult.model_id).filter_by(
+        project_id=combination.project_id, lib1_id=combination.lib1_id,
+        lib2_id=combination.lib2_id)
+    cell_models_query = session.query(models.Model)\
+        .filter(models.Model.id.in_(combination_models.subquery()))
+    all_cell_models = pd.read_sql(cell_models_query.statement, session.bind)\
         .rename(columns={'cell_line_name': 'model_name'})
 
     # We need the single agent IC50s for the MM plot